@@ -0,0 +1,83 @@
+"""
+Async versions of the FilterSet and Filter APIs, for use in async views.
+Requires Python 3.5 or later.
+
+The ORM is synchronous, so queries are run in threads of an executor, and
+several filters are computed at the same time with asyncio.gather.
+"""
+import asyncio
+
+from .filterset import call_in_thread
+
+
+async def run_in_thread(func, *args, executor=None):
+    """
+    Runs func(*args) in a thread of executor (the event loop's default
+    executor if None), and returns the result.
+    """
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(executor, call_in_thread, func, *args)
+
+
+async def acompute(filterset):
+    """
+    Computes the choices of all the filters of filterset, doing the queries of
+    up to filterset.max_parallel_filters filters at the same time, and returns
+    a dictionary of field name to choices.
+
+    Afterwards, rendering the filterset does not need any more queries.
+
+    If other database connections can't see the objects (e.g. inside a
+    transaction), the queries are done in the current thread, which blocks
+    the event loop.
+    """
+    if hasattr(filterset, '_cached_filter_choices'):
+        choices = filterset._cached_filter_choices
+        if all(f.field in choices for f in filterset.filters):
+            return dict(choices)
+
+    def compute_all():
+        return dict((f.field, filterset.get_filter_choices(f.field))
+                    for f in filterset.filters)
+
+    executor = filterset.executor
+    if not filterset.can_use_other_connections():
+        # Only the current connection can see the data, so everything has to
+        # be done in this thread.
+        return compute_all()
+    if not filterset.can_use_other_threads():
+        # Temporary tables are only visible to the connection that creates
+        # them, so everything is done in one other thread.
+        return await run_in_thread(compute_all, executor=executor)
+
+    def prepare():
+        if not hasattr(filterset, '_cached_filter_choices'):
+            filterset.prepare_choices()
+        # Chosen objects are looked up here, since they are shared between
+        # filters.
+        for f in filterset.filters:
+            getattr(f, 'chosen', None)
+
+    await run_in_thread(prepare, executor=executor)
+
+    cached = filterset._cached_filter_choices
+    semaphore = asyncio.Semaphore(filterset.max_parallel_filters)
+
+    async def get_choices(f):
+        async with semaphore:
+            return await run_in_thread(f.get_choices, filterset.qs,
+                                       executor=executor)
+
+    pending = [f for f in filterset.filters if f.field not in cached]
+    results = await asyncio.gather(*[get_choices(f) for f in pending])
+    for f, choices in zip(pending, results):
+        cached[f.field] = choices
+    return dict((f.field, cached[f.field]) for f in filterset.filters)
+
+
+async def arender(filterset):
+    """
+    Async version of FilterSet.render().
+    """
+    await acompute(filterset)
+    return filterset.render()
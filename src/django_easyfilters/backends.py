@@ -0,0 +1,195 @@
+"""
+Database specific SQL used by the count queries in the queries module.
+
+The backend for a connection is chosen using connection.vendor. FacetBackend
+produces generic SQL, and subclasses use the faster forms that particular
+databases support.
+"""
+from django import VERSION
+
+
+class FacetBackend(object):
+    """
+    Generic SQL, for databases without a more specific backend.
+    """
+    # The default strategy for queries.m2m_value_counts.
+    m2m_count_strategy = 'in'
+
+    # Whether queries.materialized_queryset can be used, which needs temporary
+    # tables that can be used more than once in a query, and the SQL of the
+    # *_temp_table_sql methods.
+    can_materialize = False
+
+    # SQL that selects the values of an array parameter, used to pass a list
+    # of primary keys as a single parameter, or None if not supported.
+    array_values_sql = None
+
+    def __init__(self, connection):
+        self.connection = connection
+
+    def date_trunc_sql(self, lookup_type, col):
+        """
+        Returns SQL that truncates the date in col to the 'year', 'month' or
+        'day'.
+        """
+        return self.connection.ops.date_trunc_sql(lookup_type, col)
+
+    def datetime_trunc_sql(self, lookup_type, col, tzname):
+        """
+        Returns (sql, params) for SQL that truncates the datetime in col to
+        the 'year', 'month' or 'day', in time zone 'tzname' (None if USE_TZ is
+        False). Only used from Django 1.6.
+        """
+        return self.connection.ops.datetime_trunc_sql(lookup_type, col, tzname)
+
+    def numeric_sql(self, col):
+        """
+        Returns SQL that converts the value of col to a type that is divided
+        without truncation, even when it and the divisor are whole numbers.
+        """
+        return 'CAST(%s AS REAL)' % col
+
+    def ceil_sql(self, sql):
+        """
+        Returns SQL for the smallest integer that is not less than the
+        (non-negative) value of sql, and the number of times sql is repeated.
+        """
+        return 'CEILING(%s)' % sql, 1
+
+    def uniform_bucket_sql(self, col, lower, step):
+        """
+        Returns (sql, params) for an expression that gives i + 1 for a value
+        of col in the range (lower + i * step, lower + (i + 1) * step], or 0
+        if col equals lower.
+        """
+        # The quotient is rounded, so that inexact floating point division
+        # doesn't push values on a boundary into the next range.
+        sql, repeat = self.ceil_sql('ROUND((%s - %%s) / %%s, 9)'
+                                    % self.numeric_sql(col))
+        return sql, (lower, step) * repeat
+
+    def create_temp_table_sql(self, table, select_sql):
+        """
+        Returns SQL that creates temporary table 'table' from the results of
+        select_sql.
+        """
+        return 'CREATE TEMPORARY TABLE %s AS %s' % (table, select_sql)
+
+    def analyze_temp_table_sql(self, table):
+        """
+        Returns SQL that updates the planner statistics for a temporary table,
+        or None if the database does not need it.
+        """
+        return None
+
+    def drop_temp_table_sql(self, table):
+        """
+        Returns SQL that drops temporary table 'table', if it exists.
+        """
+        return 'DROP TABLE IF EXISTS %s' % table
+
+    def table_sample_sql(self, table, pk_column):
+        """
+        Returns SQL that selects pk_column from a random sample of the rows of
+        'table', with parameters for the percentage of rows and a seed, so
+        that the same sample is selected each time the SQL is run, or None if
+        the database can't sample tables.
+        """
+        return None
+
+
+class PostgreSQLBackend(FacetBackend):
+
+    m2m_count_strategy = 'join'
+
+    can_materialize = True
+
+    array_values_sql = 'SELECT UNNEST(%s)'
+
+    def numeric_sql(self, col):
+        # ROUND(x, n) only exists for NUMERIC.
+        return 'CAST(%s AS NUMERIC)' % col
+
+    def uniform_bucket_sql(self, col, lower, step):
+        return ('CEIL(ROUND((%s - %%s) / %%s, 9))' % self.numeric_sql(col),
+                (lower, step))
+
+    def analyze_temp_table_sql(self, table):
+        # Temporary tables are not analyzed automatically, so the planner
+        # would have to guess their size.
+        return 'ANALYZE %s' % table
+
+    def table_sample_sql(self, table, pk_column):
+        if getattr(self.connection, 'pg_version', 0) >= 90500:
+            # Without REPEATABLE, each query would see a different sample.
+            return ('SELECT %s FROM %s TABLESAMPLE SYSTEM (%%s) '
+                    'REPEATABLE (%%s)' % (pk_column, table))
+        return None
+
+
+class MySQLBackend(FacetBackend):
+
+    m2m_count_strategy = 'join'
+
+    def numeric_sql(self, col):
+        # Division never truncates, and CAST(... AS REAL) is not supported by
+        # older versions.
+        return col
+
+
+class SQLiteBackend(FacetBackend):
+
+    m2m_count_strategy = 'exists'
+
+    can_materialize = True
+
+    # strftime formats that give the same result as Django's date and datetime
+    # truncation functions, which are implemented in Python, so are much
+    # slower. From Django 1.6, date truncation is only used for DateFields,
+    # and gives dates.
+    datetime_trunc_formats = {
+        'year': '%%Y-01-01 00:00:00',
+        'month': '%%Y-%%m-01 00:00:00',
+        'day': '%%Y-%%m-%%d 00:00:00',
+    }
+    if VERSION >= (1, 6):
+        date_trunc_formats = {
+            'year': '%%Y-01-01',
+            'month': '%%Y-%%m-01',
+            'day': '%%Y-%%m-%%d',
+        }
+    else:
+        date_trunc_formats = datetime_trunc_formats
+
+    def date_trunc_sql(self, lookup_type, col):
+        return "strftime('%s', %s)" % (self.date_trunc_formats[lookup_type],
+                                       col)
+
+    def datetime_trunc_sql(self, lookup_type, col, tzname):
+        if tzname is not None:
+            # strftime can't convert to another time zone.
+            return super(SQLiteBackend, self).datetime_trunc_sql(
+                lookup_type, col, tzname)
+        sql = "strftime('%s', %s)" % (self.datetime_trunc_formats[lookup_type],
+                                      col)
+        return sql, []
+
+    def ceil_sql(self, sql):
+        # There is no CEIL function. CAST truncates, which is the same as
+        # FLOOR for the non-negative values here.
+        return ('(CAST(%s AS INTEGER) + (%s > CAST(%s AS INTEGER)))'
+                % (sql, sql, sql), 3)
+
+
+BACKENDS = {
+    'postgresql': PostgreSQLBackend,
+    'mysql': MySQLBackend,
+    'sqlite': SQLiteBackend,
+}
+
+
+def get_backend(connection):
+    """
+    Returns the FacetBackend for the connection.
+    """
+    return BACKENDS.get(connection.vendor, FacetBackend)(connection)
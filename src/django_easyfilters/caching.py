@@ -0,0 +1,240 @@
+"""
+Caching of facet counts across requests.
+"""
+import hashlib
+import re
+import threading
+import time
+
+from django.db import connections
+from django.db.models import signals
+from django.db.models.sql.datastructures import EmptyResultSet
+
+try:
+    from django.core.cache import caches
+
+    def get_cache(alias):
+        return caches[alias]
+except ImportError:  # Django < 1.7 fallback
+    from django.core.cache import get_cache
+
+try:
+    from django.apps import apps
+    get_models = apps.get_models
+except ImportError:  # Django < 1.7 fallback
+    from django.db.models import get_models
+
+try:
+    from collections import OrderedDict
+except ImportError:  # Python 2.6 fallback
+    from django.utils.datastructures import SortedDict as OrderedDict
+
+from .queries import with_materialized_sql
+
+
+class LRUCache(object):
+    """
+    A small, thread-safe, in-process cache that holds at most 'max_size'
+    items, each for at most 'timeout' seconds.
+    """
+    def __init__(self, max_size=1000, timeout=300):
+        self.max_size = max_size
+        self.timeout = timeout
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                expires, value = self._data.pop(key)
+            except KeyError:
+                return default
+            if expires < time.time():
+                return default
+            # Re-insert, to mark as most recently used.
+            self._data[key] = (expires, value)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data.pop(key, None)
+            while len(self._data) >= self.max_size:
+                del self._data[next(iter(self._data))]
+            self._data[key] = (time.time() + self.timeout, value)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+class FacetCache(object):
+    """
+    Caches the results of the count queries done by filters, using a Django
+    cache backend, with an in-process LRU cache in front of it.
+
+    Keys are built from the SQL of the query, so they include everything that
+    affects the counts. They also include a generation number for each table
+    the query uses, which is bumped whenever a model instance is saved or
+    deleted, or a many-to-many relation changed, so that changes made through
+    the ORM invalidate the cached data. This is done for the models of the
+    tables that count queries in the process have used. Other changes (e.g.
+    QuerySet.update(), or saves in a process that has not used the table) are
+    only picked up when entries expire.
+    """
+    def __init__(self, cache_alias='default', timeout=300, local_size=1000,
+                 key_prefix='easyfilters'):
+        self.cache_alias = cache_alias
+        self.timeout = timeout
+        self.key_prefix = key_prefix
+        self.local = LRUCache(max_size=local_size, timeout=timeout)
+        _facet_caches.setdefault((cache_alias, key_prefix), self)
+
+    @property
+    def cache(self):
+        return get_cache(self.cache_alias)
+
+    def get_counts(self, func, qs, *args):
+        """
+        Returns func(qs, *args), using the cached value if there is one.
+        """
+        connection = connections[qs.db]
+        try:
+            sql, params = qs.query.get_compiler(qs.db).as_sql()
+        except EmptyResultSet:
+            # No query would be done anyway
+            return func(qs, *args)
+        tables = self.get_tables(connection, with_materialized_sql(sql))
+        generations = self.get_generations(tables)
+        key = self.make_key(func, qs.db, sql, params, args, generations)
+
+        counts = self.local.get(key)
+        if counts is None:
+            counts = self.cache.get(key)
+            if counts is None:
+                counts = func(qs, *args)
+                self.cache.set(key, counts, self.timeout)
+            self.local.set(key, counts)
+        return counts
+
+    def get_tables(self, connection, sql):
+        # Subqueries mean that the tables in the SQL can't be found just from
+        # the Query object, so we look for their quoted names in the SQL
+        # itself. A false positive just means some unnecessary invalidation.
+        quoted_tables, quoted_re = get_quoted_tables(connection)
+        tables = sorted(set(quoted_tables[name]
+                            for name in quoted_re.findall(sql)
+                            if name in quoted_tables))
+        watch_tables(tables)
+        return tables
+
+    def generation_key(self, table):
+        return '%s:gen:%s' % (self.key_prefix, table)
+
+    def get_generations(self, tables):
+        keys = [self.generation_key(t) for t in tables]
+        generations = self.cache.get_many(keys)
+        for key in keys:
+            if key not in generations:
+                # Start from the time, not 0, so that a generation that has
+                # been evicted from the cache does not revive old entries.
+                self.cache.add(key, int(time.time() * 1000), None)
+                generations[key] = self.cache.get(key)
+        return [generations[key] for key in keys]
+
+    def make_key(self, func, using, sql, params, args, generations):
+        fingerprint = repr((func.__module__, func.__name__, using, sql,
+                            params, args, generations))
+        return '%s:counts:%s' % (self.key_prefix,
+                                 hashlib.md5(fingerprint.encode('utf-8'))
+                                 .hexdigest())
+
+    def invalidate(self, table):
+        key = self.generation_key(table)
+        try:
+            self.cache.incr(key)
+        except ValueError:
+            self.cache.set(key, int(time.time() * 1000), None)
+
+
+# One FacetCache for each (cache_alias, key_prefix) in use, whose generations
+# are bumped by model_changed.
+_facet_caches = {}
+
+# {connection alias: ({quoted table name: table}, regex for quoted names)}
+_quoted_tables = {}
+
+# The tables that model_changed is connected for, and a lock for connecting.
+_watched_tables = set()
+_watch_lock = threading.Lock()
+
+
+def get_table_models():
+    """
+    Returns a dictionary of {table: [models]} for all installed models,
+    including intermediate models and proxies.
+    """
+    table_models = {}
+    for model in get_models(include_auto_created=True):
+        table_models.setdefault(model._meta.db_table, []).append(model)
+    return table_models
+
+
+def get_quoted_tables(connection):
+    """
+    Returns ({quoted table name: table}, regex), where the regex finds quoted
+    names in SQL for 'connection'.
+    """
+    try:
+        return _quoted_tables[connection.alias]
+    except KeyError:
+        pass
+    qn = connection.ops.quote_name
+    quoted = qn('x')
+    i = quoted.lower().index('x')
+    open_quote, close_quote = quoted[:i], quoted[i + 1:]
+    quoted_re = re.compile('%s[^%s]*%s' % (re.escape(open_quote),
+                                           re.escape(close_quote),
+                                           re.escape(close_quote)))
+    quoted_tables = dict((qn(table), table) for table in get_table_models())
+    return _quoted_tables.setdefault(connection.alias,
+                                     (quoted_tables, quoted_re))
+
+
+def watch_tables(tables):
+    """
+    Connects model_changed to the signals of the models of 'tables', so that
+    saving them invalidates cached counts.
+    """
+    if _watched_tables.issuperset(tables):
+        return
+    with _watch_lock:
+        table_models = get_table_models()
+        for table in tables:
+            if table in _watched_tables:
+                continue
+            for model in table_models.get(table, []):
+                for signal in [signals.post_save, signals.post_delete,
+                               signals.m2m_changed]:
+                    signal.connect(model_changed, sender=model,
+                                   dispatch_uid='django_easyfilters.caching')
+            _watched_tables.add(table)
+
+
+def model_changed(sender, **kwargs):
+    """
+    Bumps the generation of the table of model 'sender' (the intermediate
+    model for m2m_changed) in every cache used by a FacetCache.
+
+    It is connected for the models of tables that count queries have used
+    (see watch_tables), so that saving other models costs nothing.
+    """
+    if not kwargs.get('action', 'post_').startswith('post_'):
+        # The pre_* actions of m2m_changed
+        return
+    table = sender._meta.db_table
+    for facet_cache in list(_facet_caches.values()):
+        facet_cache.invalidate(table)
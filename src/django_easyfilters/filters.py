@@ -4,19 +4,31 @@ import math
 import operator
 import re
 from datetime import date
+from datetime import datetime
 from logging import getLogger
 
 import six
 from dateutil.relativedelta import relativedelta
-from django import VERSION
 from django.core.exceptions import ValidationError
-from django.db import models
+from django.http import QueryDict
 from django.utils.dates import MONTHS
-
-from .queries import date_aggregation
+from django.utils.datastructures import MultiValueDict
+from django.utils.datastructures import SortedDict
+
+from . import memory
+from .queries import capped_value_counts
+from .queries import date_counts
+from .queries import date_stats
+from .queries import get_m2m_count_strategy
+from .queries import labelled_value_counts
+from .queries import m2m_value_counts
+from .queries import normalize_queryset
 from .queries import numeric_range_counts
+from .queries import numeric_stats
+from .queries import top_value_counts
 from .queries import value_counts
 from .ranges import auto_ranges
+from .utils import cached_property
 from .utils import get_model_field
 from .utils import python_2_unicode_compatible
 
@@ -35,6 +47,7 @@ else:
 try:
     from collections import namedtuple
     FilterChoice = namedtuple('FilterChoice', 'label count params link_type')
+    ValuesPage = namedtuple('ValuesPage', 'next_after complete')
 except ImportError:
     # We don't use it as a tuple, so this will do:
     class FilterChoice(object):
@@ -42,10 +55,15 @@ except ImportError:
             self.label, self.count, self.params, self.link_type = \
                 label, count, params, link_type
 
+    class ValuesPage(object):
+        def __init__(self, next_after, complete):
+            self.next_after, self.complete = next_after, complete
+
 
 FILTER_ADD = 'add'
 FILTER_REMOVE = 'remove'
 FILTER_DISPLAY = 'display'
+FILTER_MORE = 'more'
 
 
 class Filter(object):
@@ -63,7 +81,9 @@ class Filter(object):
                  query_param=None,
                  order_by_count=False,
                  sticky=False,
-                 show_counts=True):
+                 show_counts=True,
+                 cache=None,
+                 count_cap=None):
         self.field = field
         self.model = model
         self.params = params
@@ -71,22 +91,35 @@ class Filter(object):
             query_param = field
         self.query_param = query_param
         self.order_by_count = order_by_count
-        self.field_obj, m2m = get_model_field(self.model, self.field)
+        self.field_obj, self.m2m = get_model_field(self.model, self.field)
 
         if self.field_obj.rel is not None:
             self.rel_model = self.field_obj.rel.to
             self.rel_field = self.field_obj.rel.get_related_field()
-        # Make chosen an immutable sequence, to stop accidental mutation.
-        self.chosen = tuple(self.choices_from_params())
         self.sticky = sticky
         self.show_counts = show_counts
+        self.cache = cache
+        self.count_cap = count_cap
+
+    @cached_property
+    def chosen(self):
+        # Make chosen an immutable sequence, to stop accidental mutation.
+        return tuple(self.choices_from_params())
+
+    @property
+    def lookup_choices(self):
+        """
+        The choices that apply_filter uses. Subclasses can override this to
+        avoid work that is only needed for displaying the chosen values.
+        """
+        return self.chosen
 
     def apply_filter(self, qs):
         """
         Apply the filtering defined in params (request.GET) to the queryset qs,
         returning the new QuerySet.
         """
-        chosen = list(self.chosen)
+        chosen = list(self.lookup_choices)
         while len(chosen) > 0:
             lookup = self.lookup_from_choice(chosen.pop())
             if self.sticky:
@@ -101,6 +134,42 @@ class Filter(object):
         """
         raise NotImplementedError()
 
+    def get_choices_add_page(self, qs):
+        """
+        Returns (choices, page), where choices are the 'add' choices, and page
+        is a ValuesPage if they are only some of them, or None. By default,
+        all the choices from get_choices_add are returned.
+
+        ValuesPage.next_after is the 'after' for the next page, or None if
+        there are no more, and ValuesPage.complete is True if the choices
+        include all the values.
+        """
+        return self.get_choices_add(qs), None
+
+    def get_choices_more(self, page):
+        """
+        Returns a list with a FILTER_MORE choice linking to the next page of
+        'add' choices after ValuesPage 'page', or an empty list.
+        """
+        return []
+
+    def aget_choices(self, qs, executor=None):
+        """
+        Async version of get_choices, returning an awaitable. The queries are
+        done in a thread of executor (by default, the event loop's default
+        executor). Requires Python 3.5 or later.
+        """
+        from .aio import run_in_thread
+        return run_in_thread(self.get_choices, qs, executor=executor)
+
+    def aget_chosen(self, executor=None):
+        """
+        Returns an awaitable for self.chosen, which may need queries to look up
+        related objects.
+        """
+        from .aio import run_in_thread
+        return run_in_thread(lambda: self.chosen, executor=executor)
+
     ### Methods that are used by base implementation above ###
 
     def choices_from_params(self):
@@ -149,7 +218,7 @@ class Filter(object):
         add is an optional item to add,
         remove is an option list of items to remove.
         """
-        params = self.params.copy()
+        params = copy_params(self.params)
         chosen = list(self.chosen)
         for r in remove:
             chosen.remove(r)
@@ -166,8 +235,43 @@ class Filter(object):
         else:
             params.pop(self.query_param, None)
         params.pop('page', None)  # links should reset paging
+        params.pop(self.query_param + '--after', None)
         return params
 
+    @cached_property
+    def urlencode_base(self):
+        # List of (key, encoded) for self.params, where encoded is None for the
+        # keys that build_params can change.
+        dynamic = set(self.dynamic_param_keys())
+        return [(key, None if key in dynamic else urlencode_list(self.params,
+                                                                 key, values))
+                for key, values in self.params.lists()]
+
+    def dynamic_param_keys(self):
+        # The keys build_params can set, in the order it sets them, 'page'
+        # which it removes, and the key for the next page of choices.
+        return [self.query_param + '--isnull', self.query_param, 'page',
+                self.query_param + '--after']
+
+    def urlencode_params(self, params):
+        """
+        For params returned by build_params, returns the same as
+        params.urlencode(), but only encodes the parameters for this filter,
+        reusing the encoded version of all the others.
+        """
+        parts = []
+        for key, encoded in self.urlencode_base:
+            if encoded is None:
+                encoded = urlencode_list(params, key, params.getlist(key))
+            if encoded:
+                parts.append(encoded)
+        # Keys added by build_params come at the end.
+        for key in self.dynamic_param_keys():
+            if key not in self.params and key in params:
+                parts.append(urlencode_list(params, key, params.getlist(key)))
+        # A native string, like QueryDict.urlencode() returns.
+        return str('&').join(parts)
+
     def sort_choices(self, qs, choices):
         """
         Sorts the choices by applying order_by_count if applicable.
@@ -191,6 +295,59 @@ class Filter(object):
                                         FILTER_REMOVE))
         return choices
 
+    def prefetch_values_counts(self, qs, counts):
+        """
+        Stores the result of get_values_counts(qs), computed elsewhere (e.g. by
+        a FilterSet doing a combined query), so that it is not queried again.
+        """
+        self._prefetched_counts = (qs, counts)
+
+    def get_row_fields(self):
+        """
+        Returns the names of the fields whose values are needed to compute the
+        counts in memory, from the rows of the QuerySet (see prefetch_rows).
+        """
+        return [] if self.m2m else [self.field]
+
+    def prefetch_rows(self, qs, rows):
+        """
+        Stores a memory.FacetRows for qs, fetched elsewhere (e.g. by a
+        FilterSet), so that counts for qs are computed from it in memory,
+        where possible, instead of by queries.
+        """
+        self._prefetched_rows = (qs, rows)
+
+    def get_counts(self, func, qs, *args):
+        """
+        Returns func(qs, *args), where func is one of the count functions in
+        the queries module, going through the cache if there is one.
+        """
+        prefetched = getattr(self, '_prefetched_rows', None)
+        if prefetched is not None and prefetched[0] is qs:
+            try:
+                return memory.get_counts(prefetched[1], func, *args)
+            except memory.NotFetched:
+                pass
+        qs = normalize_queryset(qs)
+        if self.cache is None:
+            return func(qs, *args)
+        return self.cache.get_counts(func, qs, *args)
+
+    def get_prefetched_counts(self, qs):
+        prefetched = getattr(self, '_prefetched_counts', None)
+        if prefetched is not None and prefetched[0] is qs:
+            return prefetched[1]
+        return None
+
+    def cap_counts(self, count_dict):
+        """
+        Returns a copy of count_dict (as returned by capped_value_counts) with
+        the counts above count_cap replaced by CappedCount(count_cap).
+        """
+        cap = self.count_cap
+        return SortedDict((val, CappedCount(cap) if count > cap else count)
+                          for val, count in count_dict.items())
+
     def render_choice_object(self, choice_obj):
         """
         Converts an object that is available for choosing (that usually is the
@@ -203,6 +360,36 @@ class Filter(object):
         return six.text_type(choice_obj)
 
 
+def copy_params(params):
+    """
+    Returns a mutable copy of the QueryDict/MultiValueDict params. This is
+    much faster than params.copy(), which does a deepcopy, since only the lists
+    need copying.
+    """
+    if isinstance(params, QueryDict):
+        new = QueryDict('', mutable=True, encoding=params.encoding)
+    elif type(params) is MultiValueDict:
+        new = MultiValueDict()
+    else:
+        return params.copy()
+    for key, values in params.lists():
+        new.setlist(key, list(values))
+    return new
+
+
+def urlencode_list(params, key, values):
+    """
+    Returns the urlencoded form of key=values, as params.urlencode() would
+    produce it.
+    """
+    if not values:
+        return ''
+    single = QueryDict('', mutable=True,
+                       encoding=getattr(params, 'encoding', None))
+    single.setlist(key, values)
+    return single.urlencode()
+
+
 class SingleValueMixin(object):
     """
     A mixin for filters where the field conceptually has just one value.
@@ -232,8 +419,12 @@ class ChooseOnceMixin(SingleValueMixin):
         if len(choices_remove) > 0:
             return choices_remove
         else:
-            choices_add = self.normalize_add_choices(self.get_choices_add(qs))
-            return self.sort_choices(qs, choices_add)
+            choices_add, page = self.get_choices_add_page(qs)
+            if page is None or page.complete:
+                # Only when all the choices are shown.
+                choices_add = self.normalize_add_choices(choices_add)
+            return (self.sort_choices(qs, choices_add) +
+                    self.get_choices_more(page))
 
     def get_choices_add(self, qs):
         raise NotImplementedError()
@@ -257,18 +448,258 @@ class ChooseAgainMixin(SingleValueMixin):
 class RelatedObjectMixin(object):
     """
     Mixin for fields that need to validate params against related field.
+
+    Filtering is done using the validated values of the related field, and the
+    related objects are only looked up when 'chosen' is needed for display.
+
+    If the 'label_field' option is given, labels are taken from that field of
+    the related model, and RelatedChoice objects are used instead of model
+    instances.
     """
+    def __init__(self, *args, **kwargs):
+        self.label_field = kwargs.pop('label_field', None)
+        super(RelatedObjectMixin, self).__init__(*args, **kwargs)
+
     def choice_from_param(self, param):
         try:
             return self.rel_field.to_python(param)
         except ValidationError:
             raise ValueError()
 
+    @cached_property
+    def chosen_pks(self):
+        return tuple(super(RelatedObjectMixin, self).choices_from_params())
+
+    @property
+    def lookup_choices(self):
+        return self.chosen_pks
+
+    def param_from_choice(self, choice):
+        if hasattr(choice, 'pk'):
+            return six.text_type(choice.pk)
+        else:
+            return super(RelatedObjectMixin, self).param_from_choice(choice)
+
+    # If set, a callable that is passed the filter and returns the chosen
+    # objects, used by FilterSet to look up objects for several filters at once.
+    objects_resolver = None
+
+    def choices_from_params(self):
+        if self.objects_resolver is not None:
+            return self.objects_resolver(self)
+        return self.objects_from_pks(self.chosen_pks)
+
+    def objects_from_pks(self, pks, obj_dict=None):
+        """
+        Returns the related objects for the list of values pks, in the same
+        order, dropping any that do not exist in the DB. obj_dict can be
+        passed in if the objects have already been looked up.
+        """
+        if obj_dict is None:
+            obj_dict = lookup_related_objects(self.rel_model, self.rel_field,
+                                              pks, label_field=self.label_field)
+        # None is the choice for 'is null', so is passed through.
+        return [None if pk is None else obj_dict[pk]
+                for pk in pks if pk is None or pk in obj_dict]
+
+    def get_labelled_counts(self, qs, fieldname):
+        """
+        Returns a SortedDict of {value: (label, count)} for fieldname, which
+        refers to the related model, using self.label_field for labels.
+        """
+        return self.get_counts(labelled_value_counts, qs, fieldname,
+                               fieldname + '__' + self.label_field)
+
+    def get_choices_add_labelled(self, count_dict):
+        """
+        Returns the 'add' choices for the non-NULL values in count_dict, as
+        returned by get_labelled_counts.
+        """
+        choices = []
+        for val, (label, count) in count_dict.items():
+            if val is None:
+                continue
+            choice = RelatedChoice(val, label)
+            choices.append(FilterChoice(self.render_choice_object(choice),
+                                        count,
+                                        self.build_params(add=choice),
+                                        FILTER_ADD))
+        return choices
+
+
+@python_2_unicode_compatible
+class RelatedChoice(object):
+    """
+    A lightweight stand-in for a related object, with just the value of the
+    related field (as 'pk') and a label.
+    """
+    __slots__ = ('pk', 'label')
+
+    def __init__(self, pk, label):
+        self.pk, self.label = pk, label
+
+    def __str__(self):
+        return six.text_type(self.label)
+
+    def __repr__(self):
+        return '<RelatedChoice %r %r>' % (self.pk, self.label)
+
+    def __eq__(self, other):
+        return isinstance(other, RelatedChoice) and self.pk == other.pk
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self.pk)
+
+
+def lookup_related_objects(model, field, values, cache=None, label_field=None):
+    """
+    Returns a dictionary of {value: object} for the objects of model that have
+    one of 'values' for 'field', using a single query. If an LRUCache is
+    passed as 'cache', it will be used to avoid looking up the same objects
+    again.
+
+    If label_field is given, RelatedChoice objects with labels from that field
+    are returned instead of model instances.
+    """
+    obj_dict = {}
+    missing = set()
+    for val in values:
+        if val is None or val in obj_dict:
+            continue
+        obj = None
+        if cache is not None:
+            obj = cache.get((model._meta.db_table, field.name, label_field,
+                             val))
+        if obj is None:
+            missing.add(val)
+        else:
+            obj_dict[val] = obj
+    if missing:
+        objs = model.objects.filter(**{field.name + '__in': list(missing)})
+        if label_field is None:
+            found = ((getattr(obj, field.attname), obj) for obj in objs)
+        else:
+            found = ((val, RelatedChoice(val, label)) for val, label
+                     in objs.values_list(field.name, label_field))
+        for val, obj in found:
+            obj_dict[val] = obj
+            if cache is not None:
+                cache.set((model._meta.db_table, field.name, label_field, val),
+                          obj)
+    return obj_dict
+
 
 class SimpleQueryMixin(object):
     """
     Mixin for filters that do a simple DB query on main table to get counts.
+
+    If the 'limit' option is given, only the values with the highest counts
+    are returned, with a link to the next page of values. If 'min_count' is
+    given, only values with at least that count are returned. Otherwise, if
+    'count_cap' is given and the possible values of the field are known (see
+    get_possible_values), counting stops above that number.
     """
+    # The most possible values that are counted separately for count_cap.
+    max_capped_values = 50
+
+    def __init__(self, *args, **kwargs):
+        self.limit = kwargs.pop('limit', None)
+        self.min_count = kwargs.pop('min_count', None)
+        super(SimpleQueryMixin, self).__init__(*args, **kwargs)
+
+    @property
+    def top_values_only(self):
+        return self.limit is not None or self.min_count is not None
+
+    def uses_value_counts(self, qs):
+        """
+        True if the counts are done by queries.value_counts, and so can be
+        combined with other filters' counts.
+        """
+        return not self.top_values_only and self.get_capped_values(qs) is None
+
+    def get_capped_values(self, qs):
+        """
+        Returns the values to count up to count_cap, or None if the counts are
+        not capped.
+        """
+        if self.count_cap is None:
+            return None
+        if not (self.show_counts or self.order_by_count):
+            # No counts are needed.
+            return None
+        return self.get_possible_values(qs)
+
+    def get_possible_values(self, qs):
+        """
+        Returns a list of all the values the field can have (including None if
+        it is nullable), if they are known without scanning the rows of qs,
+        and there are at most max_capped_values of them. Otherwise returns
+        None.
+        """
+        return None
+
+    @cached_property
+    def after(self):
+        param = self.params.get(self.query_param + '--after')
+        if not param or self.limit is None:
+            return None
+        count, _, value = param.partition(':')
+        try:
+            return int(count), self.choice_from_param(value)
+        except ValueError:
+            return None
+
+    def get_values_counts_query(self, qs):
+        """
+        Returns the (QuerySet, fieldname) that get_values_counts passes to
+        value_counts, or None if no counts are needed.
+        """
+        if not self.uses_value_counts(qs):
+            # Counts are done by get_values_counts.
+            return None
+        if self.show_counts or self.order_by_count:
+            return qs, self.field
+        return None
+
+    def get_top_values_counts(self, qs):
+        """
+        Returns (counts, page), where counts is a SortedDict of {value: count}
+        for the values with the highest counts, on the page given by params,
+        in order of value with NULL first, and page is a ValuesPage.
+        """
+        counts, more, complete = self.get_counts(top_value_counts, qs,
+                                                 self.field, self.limit,
+                                                 self.min_count, self.after)
+        next_after = None
+        if more:
+            # The last value, in order of count.
+            next_after = next((count, val) for val, count
+                              in reversed(list(counts.items())))
+        values = sorted(val for val in counts if val is not None)
+        if None in counts:
+            values.insert(0, None)
+        return (SortedDict((val, counts[val]) for val in values),
+                ValuesPage(next_after, complete))
+
+    def get_choices_add_page(self, qs):
+        if not self.top_values_only:
+            return super(SimpleQueryMixin, self).get_choices_add_page(qs)
+        counts, page = self.get_top_values_counts(qs)
+        return self.get_choices_add_from_counts(counts), page
+
+    def get_choices_more(self, page):
+        if page is None or page.next_after is None:
+            return []
+        count, val = page.next_after
+        params = self.build_params()
+        params[self.query_param + '--after'] = '%d:%s' % (
+            count, self.param_from_choice(val))
+        return [FilterChoice('(more)', None, params, FILTER_MORE)]
+
     def get_values_counts(self, qs):
         """
         Returns a SortedDict dictionary of {value: count}.
@@ -276,8 +707,20 @@ class SimpleQueryMixin(object):
         The order is the underlying order produced by sorting ascending on the
         DB field.
         """
-        if self.show_counts or self.order_by_count:
-            return value_counts(qs, self.field)
+        counts = self.get_prefetched_counts(qs)
+        if counts is not None:
+            return counts
+        if self.top_values_only:
+            return self.get_top_values_counts(qs)[0]
+        capped_values = self.get_capped_values(qs)
+        if capped_values is not None:
+            return self.cap_counts(self.get_counts(capped_value_counts, qs,
+                                                   self.field,
+                                                   self.count_cap,
+                                                   capped_values))
+        counts_query = self.get_values_counts_query(qs)
+        if counts_query is not None:
+            return self.get_counts(value_counts, *counts_query)
         else:
             return dict((val, None)
                         for val, in qs.values_list(self.field)
@@ -335,7 +778,9 @@ class ValuesFilter(ChooseOnceMixin, SimpleQueryMixin, Filter):
         """
         Called by 'get_choices', this is usually the one to override.
         """
-        count_dict = self.get_values_counts(qs)
+        return self.get_choices_add_from_counts(self.get_values_counts(qs))
+
+    def get_choices_add_from_counts(self, count_dict):
         return [FilterChoice(self.render_choice_object(val),
                              count,
                              self.build_params(add=val),
@@ -360,8 +805,14 @@ class ChoicesFilter(ValuesFilter):
         # 3) above
         return self.choices_dict.get(choice, choice)
 
-    def get_choices_add(self, qs):
-        count_dict = self.get_values_counts(qs)
+    def get_possible_values(self, qs):
+        # Only values in choices are shown.
+        values = [val for val, display in self.field_obj.flatchoices]
+        if len(values) > self.max_capped_values:
+            return None
+        return values
+
+    def get_choices_add_from_counts(self, count_dict):
         choices = []
         for val, display in self.field_obj.choices:
             # 1), 2) above
@@ -381,41 +832,73 @@ class ForeignKeyFilter(ChooseOnceMixin,
     """
     Filter for ForeignKey fields.
     """
-    def choice_from_param(self, param):
-        if param is None:
-            return self.field_obj.to_python(param)
-        else:
-            choice_pk = super(ForeignKeyFilter, self).choice_from_param(param)
-            lookup = {self.rel_field.name: choice_pk}
-            try:
-                obj = self.rel_model.objects.get(**lookup)
-            except self.rel_model.DoesNotExist:
-                raise ValueError("object does not exist in DB")
-            return obj
-
-    def param_from_choice(self, choice):
-        if hasattr(choice, 'pk'):
-            return six.text_type(choice.pk)
-        else:
-            return super(ForeignKeyFilter, self).param_from_choice(choice)
+    def get_values_counts_query(self, qs):
+        if self.label_field is not None:
+            # Counts are done along with labels by get_labelled_counts.
+            return None
+        return super(ForeignKeyFilter, self).get_values_counts_query(qs)
+
+    def get_possible_values(self, qs):
+        # The primary keys of the related objects, if there are few of them.
+        cache = self.__dict__.setdefault('_possible_values', {})
+        if qs.db not in cache:
+            values = list(self.rel_model._default_manager.using(qs.db)
+                          .order_by().values_list(self.rel_field.name,
+                                                  flat=True)
+                          [:self.max_capped_values + 1])
+            if self.field_obj.null:
+                values.append(None)
+            cache[qs.db] = (values if len(values) <= self.max_capped_values
+                            else None)
+        return cache[qs.db]
+
+    def get_row_fields(self):
+        fields = [self.field]
+        if self.label_field is not None:
+            fields.append(self.field + '__' + self.label_field)
+        return fields
 
     def get_choices_add(self, qs):
-        count_dict = self.get_values_counts(qs)
-        lookup = {self.rel_field.name + '__in': count_dict.keys()}
-        objs = self.rel_model.objects.filter(**lookup)
+        if self.label_field is not None and self.uses_value_counts(qs):
+            count_dict = self.get_labelled_counts(qs, self.field)
+            choices = []
+            if (not self.chosen_pks
+                    and self.field_obj.null
+                    and None in count_dict):
+                choices.append(FilterChoice(
+                    self.render_choice_object(NullChoice),
+                    count_dict[None][1],
+                    self.build_params(add=NullChoice),
+                    FILTER_ADD))
+            return choices + self.get_choices_add_labelled(count_dict)
+        return self.get_choices_add_from_counts(self.get_values_counts(qs))
+
+    def get_choices_add_from_counts(self, count_dict):
+        pks = [val for val in count_dict if val is not None]
+        if self.label_field is not None:
+            objs = sorted(lookup_related_objects(self.rel_model,
+                                                 self.rel_field, pks,
+                                                 label_field=self.label_field)
+                          .values(), key=operator.attrgetter('label'))
+        else:
+            objs = self.rel_model.objects.filter(
+                **{self.rel_field.name + '__in': pks})
         choices = []
 
-        null_count = (not self.chosen
-                      and self.field_obj.null
-                      and qs.filter(**{self.field + '__isnull': True}).count())
-        if null_count:
+        # The counts include NULL, if there are any.
+        if (not self.chosen_pks
+                and self.field_obj.null
+                and None in count_dict):
             choices.append(FilterChoice(self.render_choice_object(NullChoice),
-                                        null_count,
+                                        count_dict[None],
                                         self.build_params(add=NullChoice),
                                         FILTER_ADD))
 
         for o in objs:
-            pk = getattr(o, self.rel_field.attname)
+            if isinstance(o, RelatedChoice):
+                pk = o.pk
+            else:
+                pk = getattr(o, self.rel_field.attname)
             choices.append(FilterChoice(self.render_choice_object(o),
                                         count_dict[pk],
                                         self.build_params(add=o),
@@ -426,31 +909,66 @@ class ForeignKeyFilter(ChooseOnceMixin,
 
 class ManyToManyFilter(ChooseAgainMixin, RelatedObjectMixin, Filter):
 
+    def __init__(self, *args, **kwargs):
+        self.count_strategy = kwargs.pop('count_strategy', 'auto')
+        assert self.count_strategy in ['auto', 'in', 'exists', 'join']
+        super(ManyToManyFilter, self).__init__(*args, **kwargs)
+
     def get_values_counts(self, qs):
+        counts = self.get_prefetched_counts(qs)
+        if counts is not None:
+            return counts
+        through, fkey_this, fkey_other = self.get_through_fields()
+        return self.get_counts(m2m_value_counts, qs, through, fkey_this,
+                               fkey_other, self.get_excluded_pks(),
+                               get_m2m_count_strategy(qs.db,
+                                                      self.count_strategy))
+
+    def get_values_counts_query(self, qs):
+        if self.label_field is not None:
+            # Counts are done along with labels by get_labelled_counts.
+            return None
+        return self.get_through_query(qs)
+
+    def get_through_fields(self):
+        """
+        Returns (intermediate model, name of the foreign key to this model,
+        name of the foreign key to the related model).
+        """
+        # The field names are needed to cope with relations from a model to
+        # itself, where both foreign keys point to the same model.
+        return (self.field_obj.rel.through,
+                self.field_obj.m2m_field_name(),
+                self.field_obj.m2m_reverse_field_name())
+
+    def get_excluded_pks(self):
+        # We need to exclude items in other table that we have already filtered
+        # on, because they are not interesting.
+        return tuple(pk for pk in self.chosen_pks if pk is not None)
+
+    def get_through_query(self, qs):
+        """
+        Returns (QuerySet, fieldname) for counting the values of the related
+        model, based on the intermediate table.
+        """
         # It is easiest to base queries around the intermediate table, in order
         # to get counts.
-        through = self.field_obj.rel.through
-        rel_model = self.rel_model
-
-        assert rel_model != self.model, "Can't cope with this yet..."
-        fkey_this = [f for f in through._meta.fields
-                     if f.rel is not None and f.rel.to is self.model][0]
-        fkey_other = [f for f in through._meta.fields
-                      if f.rel is not None and f.rel.to is rel_model][0]
+        through, fkey_this, fkey_other = self.get_through_fields()
 
         # We need to limit items by what is in the main QuerySet (which might
         # already be filtered).
-        m2m_objs = through.objects.filter(**{fkey_this.name + '__in': qs})
+        m2m_objs = through.objects.filter(
+            **{fkey_this + '__in': normalize_queryset(qs).values('pk')})
+        m2m_objs = m2m_objs.exclude(**{fkey_other + '__in':
+                                       list(self.get_excluded_pks())})
 
-        # We need to exclude items in other table that we have already filtered
-        # on, because they are not interesting.
-        m2m_objs = m2m_objs.exclude(**{fkey_other.name + '__in': self.chosen})
-
-        # Now get counts:
-        field_name = fkey_other.name
-        return value_counts(m2m_objs, field_name)
+        return m2m_objs, fkey_other
 
     def get_choices_add(self, qs):
+        if self.label_field is not None:
+            return self.get_choices_add_labelled(
+                self.get_labelled_counts(*self.get_through_query(qs)))
+
         count_dict = self.get_values_counts(qs)
         # Now, need to lookup objects on related table, to display them.
         objs = self.rel_model.objects.filter(pk__in=count_dict.keys())
@@ -461,25 +979,6 @@ class ManyToManyFilter(ChooseAgainMixin, RelatedObjectMixin, Filter):
                              FILTER_ADD)
                 for o in objs]
 
-    def param_from_choice(self, choice):
-        return six.text_type(choice.pk)
-
-    def choices_from_params(self):
-        # To create the model instances, we override this method rather than
-        # choice_from_param in order to do a single bulk query rather than
-        # multiple queries. So 'choice_from_param' technically returns the
-        # wrong type of thing, since it returns PKs not instances.
-        chosen_pks = super(ManyToManyFilter, self).choices_from_params()
-        objs = self.rel_model.objects.filter(pk__in=chosen_pks)
-        # Now need to get original order back. But also need to be aware
-        # that some things may not exist in DB
-        obj_dict = dict([(obj.pk, obj) for obj in objs])
-        retval = []
-        for c in chosen_pks:
-            if c in obj_dict:
-                retval.append(obj_dict[c])
-        return retval
-
 
 @total_ordering
 class DateRangeType(object):
@@ -563,6 +1062,61 @@ class NullChoice(object):
 NullChoice = NullChoice()
 
 
+@python_2_unicode_compatible
+class CappedCount(int):
+    """
+    A count that was only counted up to a cap, and might be higher, which is
+    displayed as e.g. '1000+'.
+    """
+    def __str__(self):
+        return '%d+' % self
+
+    def __repr__(self):
+        return 'CappedCount(%d)' % self
+
+
+@python_2_unicode_compatible
+class EstimatedCount(int):
+    """
+    A count estimated from a sample, displayed as e.g. '~1200'. 'low' and
+    'high' are the bounds of a 95% confidence interval.
+    """
+    def __new__(cls, value, low, high):
+        obj = super(EstimatedCount, cls).__new__(cls, value)
+        obj.low, obj.high = low, high
+        return obj
+
+    @property
+    def interval(self):
+        return (self.low, self.high)
+
+    def __str__(self):
+        return '~%d' % self
+
+    def __repr__(self):
+        return 'EstimatedCount(%d, %d, %d)' % (self, self.low, self.high)
+
+
+def estimate_count(count, fraction, design_effect=1):
+    """
+    Returns an EstimatedCount for the total number of rows, given the count
+    for a random sample of 'fraction' of the rows.
+
+    The interval assumes the rows were sampled independently. Samples of
+    blocks of rows (TABLESAMPLE SYSTEM, or ranges of primary keys) vary more
+    when similar rows are stored together, and 'design_effect' is the factor
+    by which this increases the variance of the count.
+    """
+    estimate = count / fraction
+    # The sample count is binomial, so its standard deviation is about
+    # sqrt(count * (1 - fraction)).
+    error = (1.96 * math.sqrt(count * (1 - fraction) * design_effect)
+             / fraction)
+    return EstimatedCount(int(round(estimate)),
+                          max(count, int(math.floor(estimate - error))),
+                          int(math.ceil(estimate + error)))
+
+
 class AnyChoice(object):
     def make_lookup(self, field_name):
         return {}
@@ -665,6 +1219,15 @@ class DateChoice(object):
         raise ValueError()
 
     def make_lookup(self, field_name):
+        start_date, end_date = self.date_range()
+        return {field_name + '__gte': start_date,
+                field_name + '__lt':  end_date}
+
+    def date_range(self):
+        """
+        Returns (start date, end date), where the end date is the first date
+        after the choice.
+        """
         # It's easier to do this all using datetime comparisons than have a
         # separate path for the single year/month/day case.
         if self.range_type.single:
@@ -685,9 +1248,34 @@ class DateChoice(object):
         # Now add one year/month/day:
         end_date = end_date + \
             relativedelta(**{self.range_type.relativedeltaattr: 1})
+        return start_date, end_date
 
-        return {field_name + '__gte': start_date,
-                field_name + '__lt':  end_date}
+
+def as_date(dt):
+    if isinstance(dt, datetime):
+        return dt.date()
+    return dt
+
+
+def rollup_date_counts(day_counts, range_type):
+    """
+    Given a list of (date, count) for days, in order, returns the list of
+    (date, count) for the years, months or days specified by range_type, in the
+    same form as date_counts would for that range_type.
+    """
+    if range_type is DAY:
+        return list(day_counts)
+    out = []
+    for dt, count in day_counts:
+        if range_type is YEAR:
+            dt = dt.replace(month=1, day=1)
+        else:
+            dt = dt.replace(day=1)
+        if out and out[-1][0] == dt:
+            out[-1] = (dt, out[-1][1] + count)
+        else:
+            out.append((dt, count))
+    return out
 
 
 class DateTimeFilter(RangeFilterMixin, Filter):
@@ -701,6 +1289,7 @@ class DateTimeFilter(RangeFilterMixin, Filter):
     def __init__(self, *args, **kwargs):
         self.max_links = kwargs.pop('max_links', 12)
         self.max_depth = kwargs.pop('max_depth', None)
+        self.max_histogram_days = kwargs.pop('max_histogram_days', 1000)
         assert self.max_depth in ['year', 'month', None]
         self.max_depth_level = self.max_depth_levels[self.max_depth]
         super(DateTimeFilter, self).__init__(*args, **kwargs)
@@ -734,6 +1323,26 @@ class DateTimeFilter(RangeFilterMixin, Filter):
         # to get to some real choices, we define a recursive
         # function.
 
+        # Set by the first query, if nothing is chosen.
+        null_counts = []
+
+        # If the dates span a limited number of days, the counts for each day
+        # are fetched with one query, and all the levels of drill down are
+        # worked out from them, rather than doing a query for each level.
+        day_counts = []
+
+        def get_results(range_type, span_days):
+            if not day_counts:
+                if span_days <= self.max_histogram_days:
+                    day_counts.append(self.get_counts(
+                        date_counts, qs, self.field, DAY.label))
+                else:
+                    day_counts.append(None)
+            if day_counts[0] is None:
+                return self.get_counts(date_counts, qs, self.field,
+                                       range_type.label)
+            return rollup_date_counts(day_counts[0], range_type)
+
         def get_choices_add_recursive(chosen):
             range_type = None
 
@@ -741,16 +1350,20 @@ class DateTimeFilter(RangeFilterMixin, Filter):
                 range_type = chosen[-1].range_type.drilldown()
                 if range_type is None:
                     return []
+                start, end = chosen[-1].date_range()
+                span_days = (end - start).days
 
             if range_type is None:
-                # Get some initial idea of range
-                date_range = qs.aggregate(first=models.Min(self.field),
-                                          last=models.Max(self.field))
+                # Get some initial idea of range, and the number of NULLs.
+                date_range = self.get_counts(date_stats, qs, self.field)
+                null_counts.append(date_range['total'] -
+                                   date_range['present'])
                 first = date_range['first']
                 last = date_range['last']
                 if first is None or last is None:
                     # No values, can't drill down:
                     return []
+                span_days = (as_date(last) - as_date(first)).days + 1
                 if first.year == last.year:
                     if first.month == last.month:
                         range_type = DAY
@@ -759,13 +1372,7 @@ class DateTimeFilter(RangeFilterMixin, Filter):
                 else:
                     range_type = YEAR
 
-            if (VERSION >= (1, 6) and isinstance(self.field_obj,
-                                                 models.fields.DateTimeField)):
-                date_qs = qs.datetimes(self.field, range_type.label)
-            else:
-                date_qs = qs.dates(self.field, range_type.label)
-
-            results = date_aggregation(date_qs)
+            results = get_results(range_type, span_days)
 
             date_choice_counts = self.collapse_results(results, range_type)
             if len(date_choice_counts) == 1 and range_type is not None:
@@ -791,8 +1398,7 @@ class DateTimeFilter(RangeFilterMixin, Filter):
             choices.extend(self.bridge_choices(
                 chosen, [choice for choice, count in date_choice_counts]))
 
-        null_count = (not chosen
-                      and qs.filter(**{self.field + '__isnull': True}).count())
+        null_count = not chosen and null_counts and null_counts[0]
 
         if null_count:
             choices.append(
@@ -1034,13 +1640,14 @@ class NumericRangeFilter(RangeFilterMixin, SingleValueMixin, Filter):
         if NullChoice in chosen or (not self.drilldown and len(chosen) > 0):
             return []
 
-        all_vals = qs.values_list(self.field).distinct()
-
-        num = all_vals.count()
+        # Min, max, NULL count and whether there are more than max_links
+        # distinct values, in one query.
+        stats = self.get_counts(numeric_stats, qs, self.field, self.max_links)
+        num = stats['distinct'] + (1 if stats['nulls'] else 0)
 
         choices = []
         if num <= self.max_links:
-            val_counts = value_counts(qs, self.field)
+            val_counts = self.get_counts(value_counts, qs, self.field)
             for v, count in val_counts.items():
                 choice = (NullChoice if v is None
                           else self.choice_type([RangeEnd(v, True)]))
@@ -1049,32 +1656,32 @@ class NumericRangeFilter(RangeFilterMixin, SingleValueMixin, Filter):
                                             self.build_params(add=choice),
                                             FILTER_ADD))
         else:
-            null_count = (not chosen
-                          and qs.filter(**{self.field +
-                                           '__isnull': True}).count())
-            if null_count:
-                choice = NullChoice
-                choices.append(FilterChoice(self.render_choice_object(choice),
-                                            null_count if self.show_counts
-                                            else None,
-                                            self.build_params(add=choice),
-                                            FILTER_ADD))
             if self.ranges is None:
-                val_range = qs.aggregate(
-                    lower=models.Min(self.field),
-                    upper=models.Max(self.field)
-                )
-                ranges = auto_ranges(val_range['lower'],
-                                     val_range['upper'],
+                ranges = auto_ranges(stats['lower'],
+                                     stats['upper'],
                                      self.max_links)
             else:
                 ranges = self.ranges
 
             if self.show_counts or self.order_by_count:
-                val_counts = numeric_range_counts(qs, self.field, ranges)
+                # Automatic ranges cover all the values, apart from rounding
+                # errors, but values outside given ranges are left out.
+                val_counts = self.get_counts(numeric_range_counts, qs,
+                                             self.field, ranges,
+                                             self.ranges is None)
             else:
                 val_counts = dict((val, None) for val in ranges)
-            for i, (vals, count) in enumerate(val_counts.items()):
+            null_count = stats['nulls']
+            if not chosen and null_count:
+                choice = NullChoice
+                choices.append(FilterChoice(self.render_choice_object(choice),
+                                            null_count if self.show_counts
+                                            else None,
+                                            self.build_params(add=choice),
+                                            FILTER_ADD))
+            val_counts = [(vals, count) for vals, count in val_counts.items()
+                          if vals is not None]
+            for i, (vals, count) in enumerate(val_counts):
                 # For the lower bound, we make it inclusive only if it the first
                 # choice. The upper bound is always inclusive. This gives
                 # filters that behave sensibly e.g. with 10-20, 20-30, 30-40,
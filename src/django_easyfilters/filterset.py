@@ -1,42 +1,53 @@
+import random
+import threading
+from collections import namedtuple
 from logging import getLogger
 
 import six
 from django import template
+from django.db import connections
 from django.template.loader import get_template
 from django.utils.html import escape
 from django.utils.safestring import mark_safe
 from django.utils.text import capfirst
 
+from .backends import get_backend
 from .filters import ChoicesFilter
 from .filters import DateTimeFilter
 from .filters import FILTER_DISPLAY
 from .filters import FILTER_REMOVE
+from .filters import FilterChoice
 from .filters import ForeignKeyFilter
 from .filters import ManyToManyFilter
 from .filters import NumericRangeFilter
+from .filters import RelatedObjectMixin
 from .filters import ValuesFilter
+from .filters import estimate_count
+from .filters import lookup_related_objects
+from .memory import FacetRows
+from .queries import bounded_count
+from .queries import combined_value_counts
+from .queries import is_expensive_queryset
+from .queries import materialized_queryset
+from .queries import pk_array
+from .queries import pk_table
+from .queries import sampled_queryset
+from .utils import cached_property
 from .utils import get_model_field
 from .utils import python_2_unicode_compatible
 
 try:
-    from django.utils.functional import cached_property
-except ImportError:
-    class cached_property(object):
-        """
-        Decorator that converts a method with a single self argument into a
-        property cached on the instance.
-        """
-        def __init__(self, func):
-            self.func = func
-
-        def __get__(self, instance, type=None):
-            if instance is None:
-                return self
-            res = instance.__dict__[self.func.__name__] = self.func(instance)
-            return res
+    from concurrent import futures
+except ImportError:  # Python 2 without the 'futures' backport
+    futures = None
 
 logger = getLogger(__name__)
 
+# The information needed to create a filter, apart from the request params.
+FilterSpec = namedtuple('FilterSpec', 'field_name klass opts label')
+
+_filter_specs_lock = threading.Lock()
+
 
 def non_breaking_spaces(val):
     # This helps a lot with presentation, by stopping the links+count from being
@@ -45,6 +56,23 @@ def non_breaking_spaces(val):
     return mark_safe(u'&nbsp;'.join(escape(part) for part in val.split(u' ')))
 
 
+def call_in_thread(func, *args):
+    """
+    Returns func(*args), for use in a worker thread.
+    """
+    try:
+        return func(*args)
+    finally:
+        # Connections are per thread, and this thread is not part of the
+        # request/response cycle that would normally close them.
+        for connection in connections.all():
+            connection.close()
+
+
+def get_choices_in_thread(filter_, qs):
+    return call_in_thread(filter_.get_choices, qs)
+
+
 @python_2_unicode_compatible
 class FilterSet(object):
 
@@ -53,13 +81,73 @@ class FilterSet(object):
     template = None
     template_file = "django_easyfilters/default.html"
 
+    # If set to an instance of one of the classes in the renderers module, it
+    # is used instead of the template attributes/get_template to render filters.
+    renderer = None
+
     title_fields = None
     defaults = None
 
-    def __init__(self, queryset, params):
+    # If True, the results of get_fields() and get_filter_for_field() are
+    # cached for the class and model, and shared by all instances. Set to
+    # False if they depend on the instance, e.g. on the request.
+    cache_filter_specs = True
+
+    # If True, the counts for all filters that do simple value counts are
+    # fetched with a single combined query, rather than one or more per filter.
+    combine_counts = False
+
+    # An optional caching.LRUCache, used to avoid looking up the same related
+    # objects for the chosen values of ForeignKeyFilter and ManyToManyFilter
+    # again and again. A short timeout is recommended.
+    related_objects_cache = None
+
+    # An optional concurrent.futures.Executor, e.g. a ThreadPoolExecutor, used
+    # to compute the choices of the filters in parallel. Each worker thread
+    # uses its own database connections, which are closed afterwards.
+    executor = None
+
+    # The maximum number of filters computed at the same time by one FilterSet
+    # when using 'executor'.
+    max_parallel_filters = 4
+
+    # If True, the primary keys of the objects in 'qs' are stored in a
+    # temporary table, and the choices of all the filters are computed using
+    # it, so that the conditions of 'qs' are only evaluated once. If 'auto',
+    # this is done when the conditions look expensive.
+    materialize_base = False
+
+    # If True, counts are estimated from a random sample of about
+    # 'sample_percent' percent of the rows of the table, unless 'qs' has at
+    # most 'approximate_threshold' objects, when exact counts are done.
+    approximate = False
+    sample_percent = 1
+    approximate_threshold = 10000
+    # The seed that chooses the sample. If None, a random one is chosen for
+    # each instance.
+    sample_seed = None
+    # The factor by which sampling blocks of rows instead of single rows
+    # increases the variance of the counts, used to widen their intervals.
+    sample_design_effect = 1
+
+    # If set, and 'qs' has at most this number of objects, the values needed
+    # by all the filters are fetched with one query (and one for each
+    # ManyToManyFilter), and counted in memory instead of by count queries.
+    small_result_threshold = None
+
+    def __init__(self, queryset, params, pks=None):
         self.params = params
         self.model = queryset.model
+        self.pks = None if pks is None else list(pks)
         self.filters = self.setup_filters()
+        for f in self.filters:
+            if isinstance(f, RelatedObjectMixin):
+                f.objects_resolver = self.resolve_chosen_objects
+        self.base_queryset = queryset
+        if self.pks is not None:
+            pk_values = pk_array(queryset.db, self.pks)
+            queryset = queryset.filter(pk__in=self.pks if pk_values is None
+                                       else pk_values)
         self.qs = self.apply_filters(queryset)
 
     @cached_property
@@ -68,9 +156,259 @@ class FilterSet(object):
 
     def get_filter_choices(self, filter_field):
         if not hasattr(self, '_cached_filter_choices'):
-            self._cached_filter_choices = dict((f.field, f.get_choices(self.qs))
-                                               for f in self.filters)
-        return self._cached_filter_choices[filter_field]
+            self.prepare_choices()
+            if self.executor is not None and self.can_compute_in_parallel():
+                self.compute_choices_in_parallel()
+        try:
+            return self._cached_filter_choices[filter_field]
+        except KeyError:
+            filter_ = self.get_filter(filter_field)
+            choices = filter_.get_choices(self.qs)
+            self._cached_filter_choices[filter_field] = choices
+            return choices
+
+    def prepare_choices(self):
+        """
+        Does the work needed before the choices of individual filters are
+        computed.
+        """
+        self._cached_filter_choices = {}
+        if self.pks == []:
+            # There are no objects, so nothing to prepare: the count queries
+            # of the filters give no counts without being run.
+            return
+        # Temporary tables only exist for the duration of the 'with' blocks,
+        # so the choices of all the filters are computed straight away.
+        if self.use_pk_table:
+            with pk_table(self.qs.db, self.model, self.pks) as pk_values:
+                qs = self.apply_filters(
+                    self.base_queryset.filter(pk__in=pk_values))
+                self.compute_all_choices(qs, self.get_rows(qs))
+        elif self.rows is not None:
+            self.prefetch_rows(self.qs, self.rows)
+        elif self.sample is not None:
+            qs, fraction = self.sample
+            self.compute_all_choices(qs)
+            for field, choices in self._cached_filter_choices.items():
+                self._cached_filter_choices[field] = [
+                    FilterChoice(c.label,
+                                 estimate_count(c.count, fraction,
+                                                self.sample_design_effect),
+                                 c.params, c.link_type)
+                    if c.count is not None else c for c in choices]
+        elif self.use_materialized_base:
+            with materialized_queryset(self.qs) as qs:
+                self.compute_all_choices(qs)
+        elif self.combine_counts:
+            self.prefetch_counts()
+
+    def prefetch_rows(self, qs, rows):
+        for f in self.filters:
+            if hasattr(f, 'prefetch_rows'):
+                f.prefetch_rows(qs, rows)
+
+    def compute_all_choices(self, qs, rows=None):
+        if rows is not None:
+            self.prefetch_rows(qs, rows)
+        elif self.combine_counts:
+            self.prefetch_counts(qs)
+        for f in self.filters:
+            self._cached_filter_choices[f.field] = f.get_choices(qs)
+
+    @cached_property
+    def rows(self):
+        """
+        If the counts are done in memory (see 'small_result_threshold'), the
+        memory.FacetRows for 'qs', and None otherwise.
+        """
+        return self.get_rows(self.qs)
+
+    def get_rows(self, qs):
+        """
+        Returns the memory.FacetRows for 'qs' if it has at most
+        'small_result_threshold' objects, and None otherwise.
+        """
+        threshold = self.small_result_threshold
+        if threshold is None or bounded_count(qs, threshold) > threshold:
+            return None
+        fieldnames, through_fields = [], []
+        for f in self.filters:
+            if not hasattr(f, 'get_row_fields'):
+                # Custom filters that are not Filter subclasses.
+                continue
+            fieldnames.extend(name for name in f.get_row_fields()
+                              if name not in fieldnames)
+            if isinstance(f, ManyToManyFilter):
+                through_fields.append(f.get_through_fields())
+        return FacetRows(qs, fieldnames, through_fields)
+
+    @cached_property
+    def sample(self):
+        """
+        If counts are estimated (see 'approximate'), (sample_qs, fraction),
+        where sample_qs is 'qs' limited to a random sample of 'fraction' of the
+        rows of the table, and None otherwise.
+        """
+        if not self.approximate:
+            return None
+        if bounded_count(self.qs, self.approximate_threshold) <= \
+                self.approximate_threshold:
+            return None
+        seed = self.sample_seed
+        if seed is None:
+            # One seed for all the queries, so they all use the same sample.
+            seed = random.randint(0, 2 ** 31 - 1)
+        return sampled_queryset(self.qs, self.sample_percent, seed)
+
+    @cached_property
+    def use_pk_table(self):
+        """
+        True if the choices are computed using a temporary table of 'pks'.
+        """
+        if not self.pks:
+            return False
+        backend = get_backend(connections[self.qs.db])
+        return backend.array_values_sql is None and backend.can_materialize
+
+    @cached_property
+    def use_materialized_base(self):
+        """
+        True if the choices are computed using a temporary table of the
+        primary keys of the objects in qs. See 'materialize_base'.
+        """
+        if not self.materialize_base:
+            return False
+        if not get_backend(connections[self.qs.db]).can_materialize:
+            return False
+        if self.materialize_base == 'auto':
+            return len(self.filters) > 1 and is_expensive_queryset(self.qs)
+        return True
+
+    def can_compute_in_parallel(self):
+        """
+        Returns True if filters can be computed in parallel threads.
+        """
+        if futures is None or len(self.filters) < 2:
+            return False
+        if not self.can_use_other_threads():
+            return False
+        # Few queries are needed if the values are counted in memory.
+        return self.rows is None
+
+    def can_use_other_threads(self):
+        """
+        Returns True if queries can be done in other threads, which means
+        using other database connections.
+        """
+        if self.use_pk_table or self.use_materialized_base:
+            # Temporary tables are only visible to one connection.
+            return False
+        return self.can_use_other_connections()
+
+    def can_use_other_connections(self):
+        """
+        Returns True if other database connections can see the objects in
+        'qs'.
+        """
+        connection = connections[self.qs.db]
+        if getattr(connection, 'in_atomic_block', False):
+            # Other connections wouldn't see uncommitted data.
+            return False
+        name = connection.settings_dict['NAME'] or ''
+        if connection.vendor == 'sqlite' and (name == ':memory:' or
+                                              'mode=memory' in name):
+            # In-memory databases are not shared between connections.
+            return False
+        return True
+
+    def compute_choices_in_parallel(self):
+        # Chosen objects are looked up here, since they are shared between
+        # filters.
+        for f in self.filters:
+            getattr(f, 'chosen', None)
+        # Filters computed by prepare_choices (from a sample, a temporary
+        # table or rows counted in memory) are not computed again.
+        pending = [f for f in self.filters
+                   if f.field not in self._cached_filter_choices]
+        running = {}
+        while pending or running:
+            while pending and len(running) < self.max_parallel_filters:
+                f = pending.pop(0)
+                running[self.executor.submit(get_choices_in_thread, f,
+                                             self.qs)] = f
+            done, _ = futures.wait(list(running.keys()),
+                                   return_when=futures.FIRST_COMPLETED)
+            for future in done:
+                f = running.pop(future)
+                self._cached_filter_choices[f.field] = future.result()
+
+    def acompute(self):
+        """
+        Computes the choices of all filters, returning an awaitable, for use
+        in async views. Requires Python 3.5 or later.
+        """
+        from .aio import acompute
+        return acompute(self)
+
+    def arender(self):
+        """
+        Async version of render().
+        """
+        from .aio import arender
+        return arender(self)
+
+    def get_filter(self, filter_field):
+        for f in self.filters:
+            if f.field == filter_field:
+                return f
+        raise KeyError(filter_field)
+
+    def prefetch_counts(self, qs=None):
+        """
+        Computes the value counts of all filters that support it with one
+        combined query, and hands the results back to the filters.
+
+        qs is the QuerySet the choices will be computed with, 'qs' by default.
+        """
+        if qs is None:
+            qs = self.qs
+        filters, counts_queries = [], []
+        for f in self.filters:
+            get_query = getattr(f, 'get_values_counts_query', None)
+            counts_query = None if get_query is None else get_query(qs)
+            if counts_query is not None and counts_query[0].db == qs.db:
+                filters.append(f)
+                counts_queries.append(counts_query)
+        if len(filters) < 2:
+            # Nothing to be gained.
+            return
+        for f, counts in zip(filters, combined_value_counts(counts_queries)):
+            f.prefetch_values_counts(qs, counts)
+
+    def resolve_chosen_objects(self, filter_):
+        """
+        Returns the chosen objects for a ForeignKeyFilter or ManyToManyFilter.
+        The objects for all such filters are looked up together, with one query
+        per related model.
+        """
+        if not hasattr(self, '_chosen_objects'):
+            self._chosen_objects = self.lookup_chosen_objects()
+        obj_dict = self._chosen_objects[(filter_.rel_model,
+                                         filter_.rel_field.name,
+                                         filter_.label_field)]
+        return filter_.objects_from_pks(filter_.chosen_pks, obj_dict)
+
+    def lookup_chosen_objects(self):
+        values = {}
+        for f in self.filters:
+            if isinstance(f, RelatedObjectMixin):
+                key = (f.rel_model, f.rel_field.name, f.label_field)
+                values.setdefault(key, (f.rel_field, set()))[1]\
+                    .update(f.chosen_pks)
+        return dict((key, lookup_related_objects(key[0], field, pks,
+                                                 self.related_objects_cache,
+                                                 label_field=key[2]))
+                    for key, (field, pks) in values.items())
 
     def apply_filters(self, queryset):
         for f in self.filters:
@@ -78,26 +416,52 @@ class FilterSet(object):
         return queryset
 
     def render_filter(self, filter_):
-        field_obj, _m2m = get_model_field(self.model, filter_.field)
         choices = self.get_filter_choices(filter_.field)
-        ctx = {'filterlabel': capfirst(field_obj.verbose_name)}
+        ctx = {'filterlabel': self.get_filter_label(filter_.field)}
+        urlencode = getattr(filter_, 'urlencode_params',
+                            lambda params: params.urlencode())
         ctx['choices'] = [dict(label=non_breaking_spaces(c.label),
-                               url=u'?' + c.params.urlencode()
+                               url=u'?' + urlencode(c.params)
                                    if c.link_type != FILTER_DISPLAY else None,
                                link_type=c.link_type,
                                count=c.count)
                           for c in choices]
+        if self.renderer is not None:
+            return self.renderer.render(filter_.field, ctx)
         return self.get_template(filter_.field).render(template.Context(ctx))
 
     def get_template(self, field_name):
         if self.template:
-            return template.Template(self.template)
+            # Compile once per class, rather than for every filter.
+            cls = self.__class__
+            compiled = cls.__dict__.get('_compiled_template')
+            if compiled is None or compiled[0] != self.template:
+                compiled = (self.template, template.Template(self.template))
+                cls._compiled_template = compiled
+            return compiled[1]
         else:
             return get_template(self.template_file)
 
+    def iter_render(self, fields=None):
+        """
+        Yields the rendered HTML of each filter in turn. Each filter's choices
+        are only computed when it is reached, so output can be sent (e.g. with
+        StreamingHttpResponse) without waiting for the slowest filter, unless
+        temporary tables are used (see 'materialize_base'), when the choices of
+        all the filters are computed for the first one.
+
+        fields is an optional list of field names, to render only those filters
+        or to render them in a different order, e.g. cheapest first.
+        """
+        if fields is None:
+            filters = self.filters
+        else:
+            filters = [self.get_filter(f) for f in fields]
+        for f in filters:
+            yield self.render_filter(f)
+
     def render(self):
-        return mark_safe(u'\n'.join(self.render_filter(f)
-                         for f in self.filters))
+        return mark_safe(u'\n'.join(self.iter_render()))
 
     def get_fields(self):
         return self.fields
@@ -120,8 +484,33 @@ class FilterSet(object):
             else:
                 return ValuesFilter
 
-    def setup_filters(self):
-        filters = []
+    def get_filter_specs(self):
+        """
+        Returns a tuple of FilterSpec objects describing the filters to create.
+
+        Unless cache_filter_specs is False, this is static for a FilterSet
+        class and model, so it is only built once and then shared by all
+        instances.
+        """
+        if not self.cache_filter_specs:
+            if '_instance_filter_specs' not in self.__dict__:
+                self._instance_filter_specs = self.build_filter_specs()
+            return self._instance_filter_specs
+        cls = self.__class__
+        specs = cls.__dict__.get('_filter_specs', {})
+        try:
+            return specs[self.model]
+        except KeyError:
+            pass
+        with _filter_specs_lock:
+            specs = dict(cls.__dict__.get('_filter_specs', {}))
+            if self.model not in specs:
+                specs[self.model] = self.build_filter_specs()
+                cls._filter_specs = specs
+        return specs[self.model]
+
+    def build_filter_specs(self):
+        specs = []
         for f in self.get_fields():
             klass = None
             opts = {} if self.defaults is None else dict(self.defaults)
@@ -134,15 +523,32 @@ class FilterSet(object):
                     klass = f[2]
             if klass is None:
                 klass = self.get_filter_for_field(field_name)
+            field_obj, _m2m = get_model_field(self.model, field_name)
+            specs.append(FilterSpec(field_name, klass, tuple(opts.items()),
+                                    capfirst(field_obj.verbose_name)))
+        return tuple(specs)
+
+    def setup_filters(self):
+        filters = []
+        for spec in self.get_filter_specs():
+            opts = dict(spec.opts)
             logger.debug("Creating %s(%s, %s, %s, **%s)",
-                         klass.__name__,
-                         field_name,
+                         spec.klass.__name__,
+                         spec.field_name,
                          self.model,
                          self.params,
                          opts)
-            filters.append(klass(field_name, self.model, self.params, **opts))
+            filters.append(spec.klass(spec.field_name, self.model, self.params,
+                                      **opts))
         return filters
 
+    def get_filter_label(self, field_name):
+        for spec in self.get_filter_specs():
+            if spec.field_name == field_name:
+                return spec.label
+        field_obj, _m2m = get_model_field(self.model, field_name)
+        return capfirst(field_obj.verbose_name)
+
     def make_title(self):
         if self.title_fields is None:
             title_fields = [filter_.field for filter_ in self.filters]
@@ -0,0 +1,243 @@
+"""
+In-memory versions of the count functions in the queries module.
+
+When the filtered QuerySet has only a few rows, it is quicker to fetch the
+values needed by all the filters with one query, and count them in Python,
+than to do one or more aggregate queries per filter. The functions here take
+a FacetRows instead of a QuerySet, and otherwise have the same arguments and
+results as the functions in queries.
+"""
+from datetime import datetime
+
+from django import VERSION
+from django.conf import settings
+from django.db import models
+from django.utils.datastructures import SortedDict
+
+try:
+    from django.utils import timezone
+except ImportError:  # Django < 1.4 fallback, without time zone support
+    timezone = None
+
+from . import queries
+from .queries import normalize_queryset
+from .utils import get_model_field
+
+
+class NotFetched(Exception):
+    """
+    Raised when the values needed for counting were not fetched.
+    """
+    pass
+
+
+class FacetRows(object):
+    """
+    The values of 'fieldnames' for all the rows of QuerySet qs, fetched with a
+    single query, and the rows of intermediate tables that refer to them, for
+    each (through, this_fieldname, other_fieldname) in through_fields,
+    fetched with one query each.
+    """
+    def __init__(self, qs, fieldnames, through_fields=()):
+        self.qs = qs
+        rows = list(normalize_queryset(qs).values_list('pk', *fieldnames))
+        self.columns = dict((name, [row[i] for row in rows])
+                            for i, name in enumerate(fieldnames, 1))
+        self.through_rows = {}
+        for through, this_fieldname, other_fieldname in through_fields:
+            self.through_rows[(through, this_fieldname, other_fieldname)] = \
+                list(through._default_manager.db_manager(qs.db).filter(
+                    **{this_fieldname + '__in': normalize_queryset(qs)
+                       .values('pk')})
+                    .values_list(this_fieldname, other_fieldname))
+
+    def column(self, fieldname):
+        try:
+            return self.columns[fieldname]
+        except KeyError:
+            raise NotFetched(fieldname)
+
+
+def get_counts(rows, func, *args):
+    """
+    Returns the result of func(rows.qs, *args), where func is one of the count
+    functions in queries, computed from rows. Raises NotFetched if that can't
+    be done.
+    """
+    try:
+        memory_func = COUNT_FUNCTIONS[func]
+    except KeyError:
+        raise NotFetched(func.__name__)
+    return memory_func(rows, *args)
+
+
+def _count(values):
+    counts = {}
+    for val in values:
+        counts[val] = counts.get(val, 0) + 1
+    return counts
+
+
+def _sorted_counts(counts):
+    # In order of value, with NULL first, as queries.value_counts gives them.
+    out = SortedDict()
+    if None in counts:
+        out[None] = counts[None]
+    for val in sorted(val for val in counts if val is not None):
+        out[val] = counts[val]
+    return out
+
+
+def value_counts(rows, fieldname):
+    return _sorted_counts(_count(rows.column(fieldname)))
+
+
+def labelled_value_counts(rows, fieldname, label_fieldname):
+    counts = _count(zip(rows.column(fieldname),
+                        rows.column(label_fieldname)))
+    count_dict = SortedDict()
+    # Ordered by label, with NULL first.
+    for (val, label), count in sorted(counts.items(),
+                                      key=lambda item: (item[0][0] is not None,
+                                                        item[0][1] is not None,
+                                                        item[0][1],
+                                                        item[0][0])):
+        count_dict[val] = (label, count)
+    return count_dict
+
+
+def top_value_counts(rows, fieldname, limit=None, min_count=None,
+                     after=None):
+    counts = _count(rows.column(fieldname))
+    num_values = len(counts)
+    if min_count is not None:
+        counts = dict((val, count) for val, count in counts.items()
+                      if count >= min_count)
+    complete = after is None and len(counts) == num_values
+    out = SortedDict()
+    if None in counts and after is None:
+        out[None] = counts[None]
+    items = sorted(((count, val) for val, count in counts.items()
+                    if val is not None),
+                   key=lambda item: (-item[0], item[1]))
+    if after is not None:
+        items = [(count, val) for count, val in items
+                 if count < after[0] or (count == after[0] and val > after[1])]
+    more = limit is not None and len(items) > limit
+    for count, val in items[:limit]:
+        out[val] = count
+    return out, more, complete and not more
+
+
+def capped_value_counts(rows, fieldname, cap, values, batch_size=50):
+    values = set(values)
+    counts = value_counts(rows, fieldname)
+    return SortedDict((val, min(count, cap + 1))
+                      for val, count in counts.items() if val in values)
+
+
+def m2m_value_counts(rows, through, this_fieldname, other_fieldname,
+                     exclude=(), strategy='auto'):
+    try:
+        through_rows = rows.through_rows[(through, this_fieldname,
+                                          other_fieldname)]
+    except KeyError:
+        raise NotFetched(through)
+    exclude = set(exclude)
+    return _sorted_counts(_count(other for this, other in through_rows
+                                 if other not in exclude))
+
+
+def _truncate_date(val, kind):
+    # Truncates a date or naive datetime.
+    if isinstance(val, datetime):
+        val = val.replace(hour=0, minute=0, second=0, microsecond=0)
+    if kind == 'year':
+        return val.replace(month=1, day=1)
+    elif kind == 'month':
+        return val.replace(day=1)
+    return val
+
+
+def date_counts(rows, fieldname, kind):
+    # As queries.date_counts: from Django 1.6, DateFields give dates, and
+    # DateTimeFields are truncated in the current time zone if USE_TZ is True,
+    # giving aware datetimes. Before, all values are truncated as datetimes,
+    # which are in UTC, as stored, if USE_TZ is True.
+    field = get_model_field(rows.qs.model, fieldname)[0]
+    tz = None
+    if (isinstance(field, models.DateTimeField) and timezone is not None
+            and settings.USE_TZ):
+        if VERSION >= (1, 6):
+            tz = timezone.get_current_timezone()
+        else:
+            tz = timezone.utc
+
+    def truncate(val):
+        if tz is not None:
+            val = val.astimezone(tz).replace(tzinfo=None)
+        elif VERSION < (1, 6) and not isinstance(val, datetime):
+            val = datetime(val.year, val.month, val.day)
+        val = _truncate_date(val, kind)
+        if tz is not None:
+            val = timezone.make_aware(val, tz)
+        return val
+
+    counts = _count(truncate(val)
+                    for val in rows.column(fieldname) if val is not None)
+    return sorted(counts.items())
+
+
+def date_stats(rows, fieldname):
+    values = rows.column(fieldname)
+    present = [val for val in values if val is not None]
+    return dict(first=min(present) if present else None,
+                last=max(present) if present else None,
+                total=len(values),
+                present=len(present))
+
+
+def numeric_stats(rows, fieldname, max_distinct):
+    values = rows.column(fieldname)
+    present = [val for val in values if val is not None]
+    return dict(lower=min(present) if present else None,
+                upper=max(present) if present else None,
+                nulls=len(values) - len(present),
+                distinct=min(len(set(present)), max_distinct + 1))
+
+
+def _range_index(ranges, val, clamp):
+    # As queries.NumericValueRange: the lower bound is exclusive, apart from
+    # for the first range. If clamped, values below all the ranges go in the
+    # first one, and values above them in the last one, and otherwise in none
+    # (-1).
+    if val == ranges[0][0] or (clamp and val < ranges[0][0]):
+        return 0
+    for i, r in enumerate(ranges):
+        if r[0] < val <= r[1]:
+            return i
+    return len(ranges) - 1 if clamp else -1
+
+
+def numeric_range_counts(rows, fieldname, ranges, clamp=False):
+    counts = _count(None if val is None else _range_index(ranges, val, clamp)
+                    for val in rows.column(fieldname))
+    out = SortedDict()
+    if None in counts:
+        out[None] = counts[None]
+    for i in sorted(i for i in counts if i is not None and i >= 0):
+        out[ranges[i]] = counts[i]
+    return out
+
+
+COUNT_FUNCTIONS = {
+    queries.value_counts: value_counts,
+    queries.labelled_value_counts: labelled_value_counts,
+    queries.top_value_counts: top_value_counts,
+    queries.capped_value_counts: capped_value_counts,
+    queries.m2m_value_counts: m2m_value_counts,
+    queries.date_counts: date_counts,
+    queries.date_stats: date_stats,
+    queries.numeric_stats: numeric_stats,
+    queries.numeric_range_counts: numeric_range_counts,
+}
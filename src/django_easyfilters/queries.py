@@ -1,85 +1,260 @@
+import hashlib
+import operator
+import random
+import re
+import threading
+from contextlib import contextmanager
+from datetime import date
+from datetime import datetime
+from functools import reduce
+
 from django import VERSION
+from django.conf import settings
+from django.db import connections
 from django.db import models
 from django.db.backends.util import typecast_timestamp
-from django.db.models.sql.compiler import SQLCompiler
+from django.db.models.query import EmptyQuerySet
 from django.db.models.sql.constants import MULTI
-from django.db.models.sql.datastructures import Date
-from django.db.models.sql.subqueries import AggregateQuery
+from django.db.models.sql.datastructures import EmptyResultSet
 from django.utils.datastructures import SortedDict
 
+try:
+    from django.utils import timezone
+except ImportError:  # Django < 1.4 fallback, without time zone support
+    timezone = None
 
-# Some fairly brittle, low level stuff, to get the aggregation
-# queries we need.
-
+from .backends import get_backend
+from .ranges import uniform_step
+from .utils import get_model_field
 
-class DateAggregateQuery(AggregateQuery):
-    # Need to override to return a compiler not in django.db.models.sql.compiler
-    def get_compiler(self, using=None, connection=None):
-        return DateAggregateCompiler(self, connection, using)
 
-    def get_counts(self, using):
-        from django.db import connections
-        connection = connections[using]
-        return list(self.get_compiler(using, connection).results_iter())
-
-
-class DateAggregateCompiler(SQLCompiler):
-    def results_iter(self):
-        needs_string_cast = self.connection.features.needs_datetime_string_cast
+# Some fairly brittle, low level stuff, to get the aggregation
+# queries we need.
 
-        for rows in self.execute_sql(MULTI):
-            for row in rows:
-                if needs_string_cast:
-                    vals = [typecast_timestamp(str(row[0])),
-                            row[1]]
-                else:
-                    vals = row
-                yield vals
 
-    def as_sql(self, qn=None):
-        sql = ('SELECT %s, COUNT(%s) '
-               'FROM (%s) subquery '
-               'GROUP BY (%s) '
-               'ORDER BY (%s)'
-               % (DateWithAlias.alias, DateWithAlias.alias, self.query.subquery,
-                  DateWithAlias.alias, DateWithAlias.alias))
-        params = self.query.sub_params
-        return (sql, params)
+def normalize_queryset(qs):
+    """
+    Returns a copy of QuerySet qs without the parts that don't affect which
+    rows match, but can make count queries more expensive: ordering (including
+    Meta.ordering), select_related, and DISTINCT where there are no joins that
+    could produce duplicates.
 
+    All QuerySets that are counted should be passed through this.
+    """
+    if isinstance(qs, EmptyQuerySet):
+        # Before Django 1.6, QuerySet.none() keeps the SQL of the QuerySet it
+        # came from. A condition that can't match makes compiling it raise
+        # EmptyResultSet, as it does from Django 1.6.
+        qs = qs.model._base_manager.using(qs.db).filter(pk__in=[])
+    qs = qs.order_by()
+    query = qs.query
+    query.select_related = False
+    if query.distinct and not getattr(query, 'distinct_fields', None):
+        tables = [alias for alias in query.tables
+                  if query.alias_refcount.get(alias)]
+        if len(tables) <= 1:
+            # Rows from a single table can't be duplicated.
+            query.distinct = False
+    return qs
+
+
+def grouped_counts(query, expression, using):
+    """
+    Replaces the select of query (a clone of a values_list/dates query, with a
+    single column) with 'expression', and returns a list of (value, count) for
+    the values of expression, in order, using a single flat GROUP BY query.
 
-class DateWithAlias(Date):
-    alias = 'easyfilter_date_alias'
+    'expression' has an as_sql(qn, connection) method that returns (sql,
+    params), like the select columns of Django 1.6.
+    """
+    query.clear_ordering(True)
+    query.distinct = False
+    compiler = query.get_compiler(using)
+    sql, params = expression.as_sql(compiler.quote_name_unless_alias,
+                                    compiler.connection)
+    # The expression is added as an extra select, which all versions of Django
+    # put in the GROUP BY clause, along with its parameters.
+    query.select = []
+    query.default_cols = False
+    query.add_extra({'easyfilter_value': sql}, params, None, None, None, None)
+    query.set_extra_mask(['easyfilter_value'])
+    query.group_by = []
+    query.add_aggregate(models.Count('pk'), query.model, 'easyfilter_count',
+                        is_summary=False)
+    query.set_aggregate_mask(['easyfilter_count'])
+
+    rows = []
+    for chunk in query.get_compiler(using).execute_sql(MULTI):
+        rows.extend((val, int(count)) for val, count in chunk)
+    # Sorted here, rather than with ORDER BY, so that the expression doesn't
+    # need repeating, and to put NULL first on all databases.
+    rows.sort(key=lambda row: (row[0] is not None, row[0]))
+    return rows
+
+
+class DateTrunc(object):
+    """
+    Truncation of a date or datetime column to a year, month or day, using the
+    SQL from the facet backend. If 'tzname' is given, the column is a datetime,
+    which is truncated in that time zone, as for QuerySet.datetimes().
+    """
+    def __init__(self, col, lookup_type, tzname=None, is_datetime=False):
+        self.col = col
+        self.lookup_type = lookup_type
+        self.tzname = tzname
+        self.is_datetime = is_datetime
 
     def as_sql(self, qn, connection):
-        if VERSION >= (1, 6):
-            sql, params = super(DateWithAlias, self).as_sql(qn, connection)
-            return sql + ' as ' + self.alias, params
+        if isinstance(self.col, (list, tuple)):
+            col = '%s.%s' % tuple([qn(c) for c in self.col])
         else:
-            return (super(DateWithAlias, self).as_sql(qn, connection)
-                    + ' as ' + self.alias)
+            col = self.col
+        backend = get_backend(connection)
+        if self.is_datetime:
+            return backend.datetime_trunc_sql(self.lookup_type, col,
+                                              self.tzname)
+        return backend.date_trunc_sql(self.lookup_type, col), []
 
 
 def date_aggregation(date_qs):
     """
-    Performs an aggregation for a supplied DateQuerySet
+    Performs an aggregation for a supplied DateQuerySet (or, from Django 1.6,
+    DateTimeQuerySet), returning a list of (date, count), where the dates are
+    of the type the QuerySet gives: datetimes before Django 1.6, and from then
+    on dates for dates() and datetimes for datetimes(), which are aware, in the
+    current time zone, when USE_TZ is True.
     """
     # The DateQuerySet gives us a query that we need to clone and hack
-    date_q = date_qs.query.clone()
-    date_q.distinct = False
-
-    # Replace 'select' to add an alias
+    date_q = normalize_queryset(date_qs).query.clone()
     if VERSION >= (1, 6):
-        date_obj, date_field = date_q.select[0]
-        date_q.select = [(DateWithAlias(date_obj.col, date_obj.lookup_type),
-                         date_field)]
+        date_obj = date_q.select[0][0]
     else:
         date_obj = date_q.select[0]
-        date_q.select = [DateWithAlias(date_obj.col, date_obj.lookup_type)]
+    # The DateTime select of datetimes() has the name of the time zone.
+    is_datetime = hasattr(date_obj, 'tzname')
+
+    try:
+        rows = grouped_counts(date_q,
+                              DateTrunc(date_obj.col, date_obj.lookup_type,
+                                        getattr(date_obj, 'tzname', None),
+                                        is_datetime),
+                              date_qs.db)
+    except EmptyResultSet:
+        return []
+    connection = connections[date_qs.db]
+    if connection.features.needs_datetime_string_cast:
+        rows = [(typecast_timestamp(str(val)), count) for val, count in rows]
+    if is_datetime:
+        if settings.USE_TZ:
+            # As Django does for datetimes(): the truncated values are in the
+            # time zone of the query.
+            rows = [(timezone.make_aware(val.replace(tzinfo=None),
+                                         date_q.tzinfo), count)
+                    for val, count in rows]
+    elif VERSION >= (1, 6):
+        # As Django does for dates(), as the SQL can give datetimes.
+        rows = [(val.date() if isinstance(val, datetime) else val, count)
+                for val, count in rows]
+    return rows
+
+
+def date_counts(qs, fieldname, kind):
+    """
+    Returns a list of (date, count) for the values of date/datetime field
+    fieldname in the QuerySet, truncated to the 'year', 'month' or 'day'.
+    """
+    field = get_model_field(qs.model, fieldname)[0]
+    if VERSION >= (1, 6) and isinstance(field, models.DateTimeField):
+        return date_aggregation(qs.datetimes(fieldname, kind))
+    return date_aggregation(qs.dates(fieldname, kind))
+
+
+def date_stats(qs, fieldname):
+    """
+    Returns a dictionary with the 'first' and 'last' values of date/datetime
+    field fieldname in the QuerySet, the 'total' number of rows, and the
+    number of rows where the value is 'present' (not NULL).
+    """
+    return normalize_queryset(qs).aggregate(first=models.Min(fieldname),
+                                            last=models.Max(fieldname),
+                                            total=models.Count('pk'),
+                                            present=models.Count(fieldname))
+
 
-    # Now use as a subquery to do aggregation
-    query = DateAggregateQuery(date_qs.model)
-    query.add_subquery(date_q, date_qs.db)
-    return query.get_counts(date_qs.db)
+def _convert_value(connection, field, value):
+    # Values that come out of a derived table/UNION may have lost the type
+    # information that the backend would normally use to convert them. NULLs
+    # are passed through, as backends only handle them from Django 1.6.
+    if value is None or isinstance(value, date):
+        return value
+    return connection.ops.convert_values(value, field)
+
+
+def combined_value_counts(items):
+    """
+    Performs the equivalent of value_counts for several (qs, fieldname) pairs
+    using a single UNION ALL query. Each facet gets its own value column, with a
+    discriminator column to split the results back out again.
+
+    Returns a list of SortedDicts, in the same order as 'items'. All the
+    QuerySets must use the same database.
+    """
+    if not items:
+        return []
+    using = items[0][0].db
+    connection = connections[using]
+    qn = connection.ops.quote_name
+    count_alias = 'easyfilter_count'
+
+    branches, params, fields = [], [], []
+    for i, (qs, fieldname) in enumerate(items):
+        assert qs.db == using, "Can't combine queries across databases"
+        field = get_model_field(qs.model, fieldname)[0]
+        fields.append(field)
+        values_qs = normalize_queryset(qs).values_list(fieldname)\
+            .annotate(**{count_alias: models.Count('pk')})
+        try:
+            sub_sql, sub_params = values_qs.query.get_compiler(using).as_sql()
+        except EmptyResultSet:
+            # No rows, so nothing to count for this item.
+            continue
+        cols = ['NULL'] * len(items)
+        cols[i] = 'sub%d.%s' % (i, qn(field.column))
+        branches.append('SELECT %d, %s, sub%d.%s FROM (%s) sub%d'
+                        % (i, ', '.join(cols), i, qn(count_alias),
+                           sub_sql, i))
+        params.extend(sub_params)
+
+    null_counts = [None] * len(items)
+    rows = [[] for item in items]
+    if branches:
+        sql = ('%s ORDER BY %s'
+               % (' UNION ALL '.join(branches),
+                  ', '.join(str(i + 1) for i in range(len(items) + 1))))
+        cursor = connection.cursor()
+        cursor.execute(sql, params)
+        fetched = cursor.fetchall()
+    else:
+        fetched = []
+    for row in fetched:
+        i = row[0]
+        val = _convert_value(connection, fields[i], row[i + 1])
+        if val is None:
+            null_counts[i] = int(row[-1])
+        else:
+            rows[i].append((val, int(row[-1])))
+
+    results = []
+    for null_count, facet_rows in zip(null_counts, rows):
+        # Nulls come first, as with value_counts, whatever the backend's
+        # ordering of NULL.
+        count_dict = SortedDict()
+        if null_count:
+            count_dict[None] = null_count
+        for val, count in facet_rows:
+            count_dict[val] = count
+        results.append(count_dict)
+    return results
 
 
 def value_counts(qs, fieldname):
@@ -87,58 +262,282 @@ def value_counts(qs, fieldname):
     Performs a simple query returning the count of each value of
     the field 'fieldname' in the QuerySet, returning the results
     as a SortedDict of value: count
+
+    Rows where the field is NULL are counted by the same query, and come first
+    in the results, with the key None.
     """
-    values_counts = qs.filter(**{
-        fieldname+"__isnull": False
-    }).values_list(fieldname)\
-        .order_by(fieldname)\
-        .annotate(models.Count(fieldname))
+    related = getattr(get_model_field(qs.model, fieldname)[0], 'rel', None)
+    values_counts = normalize_queryset(qs).values_list(fieldname)
+    if related is None:
+        values_counts = values_counts.order_by(fieldname)
+    values_counts = values_counts\
+        .annotate(easyfilter_count=models.Count('pk'))
+    if related is not None:
+        # Ordering by a relation uses the ordering of the related model, which
+        # needs a join, so the values (primary keys) are sorted here instead.
+        values_counts = sorted(values_counts,
+                               key=lambda row: (row[0] is not None, row[0]))
+    return counts_with_nulls_first(values_counts)
+
+
+def labelled_value_counts(qs, fieldname, label_fieldname):
+    """
+    Like value_counts, but also fetches a label for each value using the same
+    query, from label_fieldname (normally a field on a related model, e.g.
+    'genre__name'). Returns a SortedDict of value: (label, count), ordered by
+    label, with NULL first.
+    """
+    rows = normalize_queryset(qs).values_list(fieldname, label_fieldname)\
+        .order_by(label_fieldname, fieldname)\
+        .annotate(easyfilter_count=models.Count('pk'))
     count_dict = SortedDict()
-    null_count = qs.filter(**{fieldname+"__isnull": True}).count()
-    if null_count:
-        count_dict[None] = null_count
-    for val, count in values_counts:
-        count_dict[val] = count
+    others = []
+    for val, label, count in rows:
+        if val is None:
+            count_dict[None] = (None, count)
+        else:
+            others.append((val, (label, count)))
+    for val, label_count in others:
+        count_dict[val] = label_count
     return count_dict
 
 
-class NumericAggregateQuery(AggregateQuery):
-    # Need to override to return a compiler not in django.db.models.sql.compiler
-    def get_compiler(self, using=None, connection=None):
-        return NumericAggregateCompiler(self, connection, using)
+def top_value_counts(qs, fieldname, limit=None, min_count=None, after=None):
+    """
+    Returns (counts, more, complete), where counts is a SortedDict of
+    {value: count} for the values of fieldname in the QuerySet with the
+    highest counts, in order of descending count and then value, 'more' is
+    True if there are more values after them, and 'complete' is True if counts
+    has all the values of fieldname in the QuerySet.
+
+    At most 'limit' values are returned, and if min_count is given, only values
+    with at least that count. For keyset paging, 'after' can be the (count,
+    value) of the last value of the previous page.
+
+    The count of NULL values (if any, and not below min_count) is included
+    first with the key None, on the first page only, and does not count
+    towards 'limit'.
+    """
+    using = qs.db
+    connection = connections[using]
+    field = get_model_field(qs.model, fieldname)[0]
+    col = 'facet.%s' % connection.ops.quote_name(field.column)
+    try:
+        sub_sql, sub_params = normalize_queryset(qs).values_list(fieldname)\
+            .query.get_compiler(using).as_sql()
+    except EmptyResultSet:
+        return SortedDict(), False, True
+
+    total_sql, params = '', []
+    having, having_params = [], []
+    if min_count is not None:
+        # The number of rows, to find if any values were left out for having
+        # fewer than min_count.
+        total_sql = ', (SELECT COUNT(*) FROM (%s) total)' % sub_sql
+        params.extend(sub_params)
+        having.append('COUNT(*) >= %s')
+        having_params.append(min_count)
+    if after is not None:
+        having.append('%s IS NOT NULL AND '
+                      '(COUNT(*) < %%s OR (COUNT(*) = %%s AND %s > %%s))'
+                      % (col, col))
+        having_params.extend([after[0], after[0],
+                              field.get_db_prep_value(after[1],
+                                                      connection=connection)])
+    sql = ('SELECT %(col)s, COUNT(*)%(total)s FROM (%(sub)s) facet '
+           'GROUP BY %(col)s' % dict(col=col, total=total_sql, sub=sub_sql))
+    params.extend(sub_params)
+    if having:
+        sql += ' HAVING ' + ' AND '.join(having)
+        params.extend(having_params)
+    sql += (' ORDER BY CASE WHEN %(col)s IS NULL THEN 0 ELSE 1 END, '
+            'COUNT(*) DESC, %(col)s' % dict(col=col))
+    if limit is not None:
+        # Room for NULL, and one more to find if there are more.
+        sql += ' LIMIT %d' % (limit + 2)
+
+    cursor = connection.cursor()
+    cursor.execute(sql, params)
+    rows = cursor.fetchall()
+    total = int(rows[0][2]) if rows and min_count is not None else None
+    rows = [(_convert_value(connection, field, row[0]), int(row[1]))
+            for row in rows]
+    counts = SortedDict()
+    if rows and rows[0][0] is None:
+        counts[None] = rows.pop(0)[1]
+    more = limit is not None and len(rows) > limit
+    for val, count in rows[:limit]:
+        counts[val] = count
+    complete = after is None and not more
+    if complete and min_count is not None:
+        complete = total == sum(counts.values())
+    return counts, more, complete
+
+
+def capped_value_counts(qs, fieldname, cap, values, batch_size=50):
+    """
+    Returns a SortedDict of {value: count} for the values of fieldname in the
+    QuerySet, like value_counts, except that each count stops at cap + 1, so
+    that values with many rows do not need them all to be counted.
+
+    Only the given 'values' (which can include None, for NULL), e.g. the
+    choices of the field, are counted, and values with no rows are left out.
+    Capped counts are done for batch_size values at a time, using a LIMIT
+    subquery for each, so there is no need to find the distinct values first.
+    """
+    using = qs.db
+    connection = connections[using]
+    qs = normalize_queryset(qs)
+    # Sorted in Python, as ordering by a relation would join to the related
+    # table for its Meta.ordering.
+    possible = values
+    values = sorted(set(val for val in possible if val is not None))
+    if None in possible:
+        values.insert(0, None)
+
+    counts = {}
+    try:
+        for start in range(0, len(values), batch_size):
+            parts, params = [], []
+            for i in range(start, min(start + batch_size, len(values))):
+                val = values[i]
+                lookup = ({fieldname + '__isnull': True} if val is None
+                          else {fieldname: val})
+                sub_sql, sub_params = qs.filter(**lookup).values_list('pk')\
+                    [:cap + 1].query.get_compiler(using).as_sql()
+                parts.append('SELECT %d, COUNT(*) FROM (%s) capped_%d'
+                             % (i, sub_sql, i))
+                params.extend(sub_params)
+            cursor = connection.cursor()
+            cursor.execute(' UNION ALL '.join(parts), params)
+            counts.update(cursor.fetchall())
+    except EmptyResultSet:
+        return SortedDict()
+    return SortedDict((val, int(counts[i])) for i, val in enumerate(values)
+                      if counts[i])
+
+
+def counts_with_nulls_first(rows):
+    # Where NULL comes in ORDER BY depends on the backend, so put it first
+    # here.
+    count_dict = SortedDict()
+    null_count = 0
+    others = []
+    for val, count in rows:
+        if val is None:
+            null_count += count
+        else:
+            others.append((val, count))
+    if null_count:
+        count_dict[None] = null_count
+    for val, count in others:
+        count_dict[val] = count_dict.get(val, 0) + count
+    return count_dict
 
-    def get_counts(self, using):
-        from django.db import connections
-        connection = connections[using]
-        return list(self.get_compiler(using, connection).results_iter())
 
+def get_m2m_count_strategy(using, strategy='auto'):
+    if strategy == 'auto':
+        strategy = get_backend(connections[using]).m2m_count_strategy
+    return strategy
 
-class NumericAggregateCompiler(SQLCompiler):
-    def results_iter(self):
-        for rows in self.execute_sql(MULTI):
-            for row in rows:
-                yield row
 
-    def as_sql(self, qn=None):
-        sql = ('SELECT %s, COUNT(%s) '
-               'FROM (%s) subquery '
-               'GROUP BY (%s) '
-               'ORDER BY (%s)'
-               % (NumericValueRange.alias, NumericValueRange.alias,
-                  self.query.subquery, NumericValueRange.alias,
-                  NumericValueRange.alias))
-        params = self.query.sub_params
-        return (sql, params)
+def m2m_value_counts(qs, through, this_fieldname, other_fieldname,
+                     exclude=(), strategy='auto'):
+    """
+    Returns the counts of each value of other_fieldname in the intermediate
+    model 'through' for the objects in QuerySet qs, which are referred to by
+    this_fieldname, as a SortedDict of value: count. Values in 'exclude' are
+    not counted.
+
+    strategy controls the SQL that is used:
+
+    * 'in': filters the intermediate table using 'IN (subquery)'
+    * 'exists': filters the intermediate table using a correlated
+      'EXISTS (subquery)'
+    * 'join': joins the intermediate table to the (distinct) primary keys of
+      qs
+    * 'auto': chooses one of the above depending on the database
+    """
+    using = qs.db
+    qs = normalize_queryset(qs)
+    strategy = get_m2m_count_strategy(using, strategy)
+    if strategy == 'in':
+        m2m_objs = through._default_manager.db_manager(using).filter(
+            **{this_fieldname + '__in': qs.values('pk')})
+        m2m_objs = m2m_objs.exclude(**{other_fieldname + '__in':
+                                       list(exclude)})
+        return value_counts(m2m_objs, other_fieldname)
+
+    connection = connections[using]
+    qn = connection.ops.quote_name
+    this_col = qn(through._meta.get_field(this_fieldname).column)
+    other_field = through._meta.get_field(other_fieldname)
+    other_col = qn(other_field.column)
+    opts = qs.model._meta
+    m2m_alias = qn('easyfilter_m2m')
+    base_alias = qn('easyfilter_base')
+
+    base_qs = qs
+    try:
+        if strategy == 'exists':
+            # The main table always has its table name as alias.
+            base_qs = base_qs.extra(where=['%s.%s = %s.%s' % (
+                qn(opts.db_table), qn(opts.pk.column), m2m_alias, this_col)])
+            sub_sql, params = base_qs.values_list('pk').query\
+                .get_compiler(using).as_sql()
+            from_sql = '%s %s' % (qn(through._meta.db_table), m2m_alias)
+            where = ['EXISTS (%s)' % sub_sql]
+        elif strategy == 'join':
+            # DISTINCT, since filtering on multi-valued relations can produce
+            # the same object more than once.
+            sub_sql, params = base_qs.values_list('pk').distinct().query\
+                .get_compiler(using).as_sql()
+            from_sql = ('(%s) %s INNER JOIN %s %s ON %s.%s = %s.%s'
+                        % (sub_sql, base_alias,
+                           qn(through._meta.db_table), m2m_alias,
+                           m2m_alias, this_col, base_alias,
+                           qn(opts.pk.column)))
+            where = []
+        else:
+            raise ValueError("Unknown strategy %r" % strategy)
+    except EmptyResultSet:
+        return SortedDict()
+
+    params = list(params)
+    exclude = list(exclude)
+    if exclude:
+        where.append('%s.%s NOT IN (%s)' % (m2m_alias, other_col,
+                                            ', '.join(['%s'] * len(exclude))))
+        params.extend(other_field.get_db_prep_value(val, connection=connection)
+                      for val in exclude)
+    sql = ('SELECT %s.%s, COUNT(*) FROM %s %s GROUP BY %s.%s ORDER BY %s.%s'
+           % (m2m_alias, other_col, from_sql,
+              ('WHERE ' + ' AND '.join(where)) if where else '',
+              m2m_alias, other_col, m2m_alias, other_col))
+    cursor = connection.cursor()
+    cursor.execute(sql, params)
+    return counts_with_nulls_first(
+        (_convert_value(connection, other_field, val), int(count))
+        for val, count in cursor.fetchall())
 
 
 class NumericValueRange(object):
-    alias = 'easyfilter_number_range_alias'
 
-    def __init__(self, col, ranges):
+    def __init__(self, col, ranges, clamp=False):
         # ranges is list of (lower, upper) bounds we want to find, where 'lower'
-        # is inclusive and upper is exclusive.
+        # is exclusive and upper is inclusive (apart from the first range,
+        # where 'lower' is inclusive). If 'clamp' is True (for ranges from
+        # auto_ranges, which cover all the values apart from rounding errors),
+        # values outside the ranges are put in the nearest one, otherwise
+        # they are left out.
         self.col = col
         self.ranges = ranges
+        self.clamp = clamp
+        # For ranges of the same size (as produced by auto_ranges), the range
+        # can be found with arithmetic, rather than one comparison per range.
+        # This puts values outside the ranges in the end ones, so is only used
+        # when they are clamped.
+        self.uniform = uniform_step(ranges) if clamp else None
 
     # TODO - do we need 'relabel_aliases', like 'Date'?
 
@@ -148,41 +547,322 @@ class NumericValueRange(object):
         else:
             col = self.col
 
-        # Build up case expression.
-        clause = (['CASE '] +
-                  ['WHEN %s > %s AND %s <= %s THEN %s '
-                   % (col, val[0], col, val[1], i)
-                   for i, val in enumerate(self.ranges)] +
-                  # An inclusive lower limit for the first item in ranges:
-                  ['WHEN %s = %s THEN 0 ' % (col, self.ranges[0][0])] +
-                  ['ELSE %s END ' % len(self.ranges)] +
-                  ['as %s' % self.alias])
-        if VERSION >= (1, 6):
-            return ''.join(clause), ()
+        if self.uniform is not None:
+            return self.uniform_sql(col, connection)
+        return self.case_sql(col), ()
+
+    def case_sql(self, col):
+        # Build up case expression. NULL values are kept as NULL, so that they
+        # are counted as a separate group.
+        return ''.join(['CASE WHEN %s IS NULL THEN NULL ' % col] +
+                       ['WHEN %s > %s AND %s <= %s THEN %s '
+                        % (col, val[0], col, val[1], i)
+                        for i, val in enumerate(self.ranges)] +
+                       # An inclusive lower limit for the first item in
+                       # ranges, which also gets values below it if they are
+                       # clamped, as the arithmetic for uniform ranges does:
+                       ['WHEN %s %s %s THEN 0 ' % (col,
+                                                   '<=' if self.clamp else '=',
+                                                   self.ranges[0][0])] +
+                       ['ELSE %s END' % (len(self.ranges) if self.clamp
+                                         else self.OUTSIDE)])
+
+    def uniform_sql(self, col, connection):
+        lower, step = self.uniform
+        return get_backend(connection).uniform_bucket_sql(col, lower, step)
+
+    # The value of the CASE expression for values outside all the ranges,
+    # when they are not clamped.
+    OUTSIDE = -1
+
+    def range_index(self, val):
+        """
+        Returns the index in ranges for the value val that was returned by the
+        SQL expression, or None if it is outside all the ranges.
+        """
+        # Values below all the ranges are included in the first range, and
+        # values above them (ELSE above) in the top range - this could be a
+        # rounding error.
+        if self.uniform is not None:
+            return min(max(int(val) - 1, 0), len(self.ranges) - 1)
+        if int(val) == self.OUTSIDE:
+            return None
+        return min(int(val), len(self.ranges) - 1)
+
+
+def numeric_stats(qs, fieldname, max_distinct):
+    """
+    Returns a dictionary with statistics for the values of 'fieldname' in the
+    QuerySet, found with a single query:
+
+    * lower, upper: the minimum and maximum values
+    * nulls: the number of NULL values
+    * distinct: the number of distinct non-NULL values, but only counted up to
+      max_distinct + 1, so that the whole table doesn't need to be scanned
+      just to find that there are more than max_distinct.
+    """
+    using = qs.db
+    connection = connections[using]
+    qn = connection.ops.quote_name
+    field = get_model_field(qs.model, fieldname)[0]
+    col = qn(field.column)
+    try:
+        sub_sql, sub_params = normalize_queryset(qs).values_list(fieldname)\
+            .query.get_compiler(using).as_sql()
+    except EmptyResultSet:
+        return dict(lower=None, upper=None, nulls=0, distinct=0)
+    sql = ('SELECT MIN(stats.%(col)s), MAX(stats.%(col)s), '
+           'COUNT(*) - COUNT(stats.%(col)s), '
+           '(SELECT COUNT(*) FROM '
+           '(SELECT DISTINCT probe.%(col)s FROM (%(sub)s) probe '
+           'WHERE probe.%(col)s IS NOT NULL LIMIT %(limit)d) distinct_probe) '
+           'FROM (%(sub)s) stats'
+           % dict(col=col, sub=sub_sql, limit=max_distinct + 1))
+    cursor = connection.cursor()
+    cursor.execute(sql, list(sub_params) * 2)
+    lower, upper, nulls, distinct = cursor.fetchone()
+    return dict(lower=_convert_value(connection, field, lower),
+                upper=_convert_value(connection, field, upper),
+                nulls=int(nulls),
+                distinct=int(distinct))
+
+
+def numeric_range_counts(qs, fieldname, ranges, clamp=False):
+    """
+    Returns a SortedDict of {range: count} for the values of fieldname that
+    fall in each of 'ranges', with the count of NULL values (if any) first,
+    with the key None. Values outside all the ranges are not counted, unless
+    'clamp' is True, when they are counted in the nearest range.
+    """
+    # Build the query:
+    query = normalize_queryset(qs).values_list(fieldname).query.clone()
+    if VERSION >= (1, 6):
+        col = query.select[0][0]
+    else:
+        col = query.select[0]
+    value_range = NumericValueRange(col, ranges, clamp)
+    try:
+        results = grouped_counts(query, value_range, qs.db)
+    except EmptyResultSet:
+        results = []
+
+    rows = []
+    for val, count in results:
+        if val is None:
+            r = None
         else:
-            return ''.join(clause)
+            i = value_range.range_index(val)
+            if i is None:
+                continue
+            r = ranges[i]
+        rows.append((r, count))
+    return counts_with_nulls_first(rows)
 
 
-def numeric_range_counts(qs, fieldname, ranges):
+class PrimaryKeySet(object):
+    """
+    A value for a 'pk__in' lookup, that is given as SQL selecting the primary
+    keys, e.g. from a temporary table.
+    """
+    def __init__(self, sql, params=()):
+        self.sql = sql
+        self.params = tuple(params)
 
-    # Build the query:
-    query = qs.values_list(fieldname).query.clone()
-    if VERSION >= (1, 6):
-        col, field = query.select[0]
-        query.select[0] = NumericValueRange(col, ranges), field
-    else:
-        query.select[0] = NumericValueRange(query.select[0], ranges)
+    def _prepare(self):
+        # Stops the ORM from treating this as a list of values.
+        return self
 
-    agg_query = NumericAggregateQuery(qs.model)
-    agg_query.add_subquery(query, qs.db)
-    results = agg_query.get_counts(qs.db)
+    def as_sql(self, qn=None, connection=None):
+        return self.sql, self.params
 
-    count_dict = SortedDict()
-    for val, count in results:
-        try:
-            r = ranges[val]
-        except IndexError:
-            # Include in the top range - this could be a rounding error
-            r = ranges[-1]
-        count_dict[r] = count
-    return count_dict
+
+# Things in the SQL for a queryset that mean the database is likely to have to
+# do more than an index lookup to find the rows: joins, subqueries and text
+# matching.
+EXPENSIVE_SQL_RE = re.compile(r'\b(JOIN|LIKE|REGEXP|GLOB|MATCH)\b|~|@@|'
+                              r'\bSELECT\b.*\bSELECT\b', re.I | re.S)
+
+
+def _pk_sql(qs):
+    return normalize_queryset(qs).values_list('pk').query\
+        .get_compiler(qs.db).as_sql()
+
+
+def is_expensive_queryset(qs):
+    """
+    Guesses whether finding the rows of QuerySet qs is expensive, from its SQL.
+    """
+    try:
+        sql, params = _pk_sql(qs)
+    except EmptyResultSet:
+        return False
+    return EXPENSIVE_SQL_RE.search(sql) is not None
+
+
+# The SQL that each temporary table created by materialized_queryset in this
+# thread was created from (temporary tables are per connection, and so per
+# thread).
+_materialized = threading.local()
+
+
+def with_materialized_sql(sql):
+    """
+    Returns sql, followed by the SQL that the temporary tables it uses were
+    created from by materialized_queryset, so that all the tables the results
+    depend on can be found in it.
+    """
+    tables = getattr(_materialized, 'tables', {})
+    return ' '.join([sql] + [source for table, source in sorted(tables.items())
+                             if table in sql])
+
+
+@contextmanager
+def materialized_queryset(qs):
+    """
+    Stores the primary keys of the objects in QuerySet qs in a temporary table,
+    and yields a QuerySet for the same objects that uses the table instead of
+    the conditions of qs. The table is dropped afterwards.
+
+    Temporary tables are only visible to the connection that created them, so
+    the QuerySet must only be used in the current thread.
+    """
+    using = qs.db
+    connection = connections[using]
+    backend = get_backend(connection)
+    qn = connection.ops.quote_name
+    try:
+        sql, params = _pk_sql(qs)
+    except EmptyResultSet:
+        yield qs
+        return
+
+    # The name depends on the query, so that the SQL of the count queries,
+    # which caching.FacetCache uses for its keys, is the same for the same qs.
+    table = qn('easyfilters_base_%s' % hashlib.md5(
+        repr((sql, params)).encode('utf-8')).hexdigest()[:16])
+    cursor = connection.cursor()
+    # A table with the same name can be left over from an earlier error on a
+    # persistent connection.
+    cursor.execute(backend.drop_temp_table_sql(table))
+    cursor.execute(backend.create_temp_table_sql(table, sql), params)
+    analyze_sql = backend.analyze_temp_table_sql(table)
+    if analyze_sql is not None:
+        cursor.execute(analyze_sql)
+    pk_sql = 'SELECT %s FROM %s' % (qn(qs.model._meta.pk.column), table)
+    if not hasattr(_materialized, 'tables'):
+        _materialized.tables = {}
+    _materialized.tables[table] = sql
+    try:
+        yield qs.model._base_manager.using(using)\
+            .filter(pk__in=PrimaryKeySet(pk_sql))
+    finally:
+        _materialized.tables.pop(table, None)
+        connection.cursor().execute(backend.drop_temp_table_sql(table))
+
+
+def pk_array(using, pks):
+    """
+    Returns a value for a 'pk__in' lookup that passes the primary keys in the
+    list pks as a single array parameter, or None if the database does not
+    support it, or pks is empty (so the ORM can tell nothing matches).
+    """
+    sql = get_backend(connections[using]).array_values_sql
+    if sql is None or not pks:
+        return None
+    return PrimaryKeySet(sql, [list(pks)])
+
+
+@contextmanager
+def pk_table(using, model, pks):
+    """
+    Stores the primary keys in the list pks in a temporary table, and yields a
+    value for a 'pk__in' lookup that selects them. The table is dropped
+    afterwards.
+
+    As for materialized_queryset, this must only be used in the current thread.
+    """
+    connection = connections[using]
+    backend = get_backend(connection)
+    qn = connection.ops.quote_name
+    pk = model._meta.pk
+    if isinstance(pk, models.AutoField):
+        pk = models.IntegerField()
+    db_type = pk.db_type(connection=connection)
+    table = qn('easyfilters_pks_%s' % hashlib.md5(
+        repr((model._meta.db_table, pks)).encode('utf-8')).hexdigest()[:16])
+    cursor = connection.cursor()
+    cursor.execute(backend.drop_temp_table_sql(table))
+    cursor.execute('CREATE TEMPORARY TABLE %s (pk %s)' % (table, db_type))
+    cursor.executemany('INSERT INTO %s VALUES (%%s)' % table,
+                       [(val,) for val in pks])
+    analyze_sql = backend.analyze_temp_table_sql(table)
+    if analyze_sql is not None:
+        cursor.execute(analyze_sql)
+    try:
+        yield PrimaryKeySet('SELECT pk FROM %s' % table)
+    finally:
+        connection.cursor().execute(backend.drop_temp_table_sql(table))
+
+
+def bounded_count(qs, limit):
+    """
+    Returns the number of objects in QuerySet qs, but only counts up to
+    limit + 1, so that a large result does not have to be counted in full.
+    """
+    try:
+        sql, params = normalize_queryset(qs).values_list('pk')[:limit + 1]\
+            .query.get_compiler(qs.db).as_sql()
+    except EmptyResultSet:
+        return 0
+    cursor = connections[qs.db].cursor()
+    cursor.execute('SELECT COUNT(*) FROM (%s) bounded' % sql, params)
+    return int(cursor.fetchone()[0])
+
+
+INTEGER_FIELD_TYPES = ('AutoField', 'BigAutoField', 'IntegerField',
+                       'BigIntegerField', 'PositiveIntegerField',
+                       'SmallIntegerField', 'PositiveSmallIntegerField')
+
+
+def sampled_queryset(qs, percent, seed, strata=10):
+    """
+    Returns (sample_qs, fraction), where sample_qs is QuerySet qs limited to a
+    random sample of about 'percent' percent of the rows of the model's table,
+    and fraction is the proportion of rows sampled. Returns None if the table
+    can't be sampled. The sample is chosen by integer 'seed', so every query
+    using sample_qs sees the same rows.
+
+    The database's own sampling is used where available. Otherwise, a random
+    range of primary keys is taken from each of 'strata' equal parts of the
+    range of primary keys, which needs integer primary keys, and assumes they
+    are spread fairly evenly.
+    """
+    using = qs.db
+    connection = connections[using]
+    model = qs.model
+    qn = connection.ops.quote_name
+    sample_sql = get_backend(connection).table_sample_sql(
+        qn(model._meta.db_table), qn(model._meta.pk.column))
+    if sample_sql is not None:
+        return (qs.filter(pk__in=PrimaryKeySet(sample_sql, [percent, seed])),
+                percent / 100.0)
+
+    if model._meta.pk.get_internal_type() not in INTEGER_FIELD_TYPES:
+        return None
+    bounds = model._base_manager.using(using).aggregate(
+        lower=models.Min('pk'), upper=models.Max('pk'))
+    if bounds['lower'] is None:
+        return None
+    lower, span = bounds['lower'], bounds['upper'] - bounds['lower'] + 1
+    strata = min(strata, span)
+    rand = random.Random(seed)
+    ranges = []
+    for i in range(strata):
+        start = lower + span * i // strata
+        size = lower + span * (i + 1) // strata - start
+        width = max(1, int(round(size * percent / 100.0)))
+        first = rand.randint(start, start + size - width)
+        ranges.append((first, first + width - 1))
+    q = reduce(operator.or_, [models.Q(pk__range=r) for r in ranges])
+    sampled = sum(last - first + 1 for first, last in ranges)
+    return qs.filter(q), sampled / float(span)
@@ -79,3 +79,27 @@ def auto_ranges(lower, upper, max_items):
             return ranges
 
     assert False, "Can't find a candidate set of ranges, logic error"
+
+
+def uniform_step(ranges):
+    """
+    If ranges (a list of (lower, upper) or (lower, upper, label) tuples) are
+    contiguous and all of the same size, returns (lower, step) as Decimals,
+    where lower is the lower bound of the first range. Otherwise returns None.
+    """
+    if not ranges:
+        return None
+    bounds = []
+    for r in ranges:
+        try:
+            bounds.append((Decimal(str(r[0])), Decimal(str(r[1]))))
+        except (ArithmeticError, ValueError):
+            return None
+    lower = bounds[0][0]
+    step = bounds[0][1] - lower
+    if step <= 0:
+        return None
+    for i, (lower_i, upper_i) in enumerate(bounds):
+        if lower_i != lower + step * i or upper_i != lower + step * (i + 1):
+            return None
+    return lower, step
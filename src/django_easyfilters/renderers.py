@@ -0,0 +1,119 @@
+"""
+Renderers that turn the choices of a filter into HTML.
+
+A renderer is set as the ``renderer`` attribute of a FilterSet subclass, and
+its ``render(field_name, ctx)`` method is called for each filter, with the same
+context data that is passed to the template by FilterSet.render_filter.
+"""
+import io
+import os
+import threading
+
+from django import template
+from django.core.exceptions import ImproperlyConfigured
+from django.template.loader import get_template
+from django.utils.html import escape
+from django.utils.safestring import mark_safe
+
+DEFAULT_TEMPLATE_PATH = os.path.join(os.path.dirname(__file__), 'templates',
+                                     'django_easyfilters', 'default.html')
+
+
+class Renderer(object):
+
+    def render(self, field_name, ctx):
+        """
+        Returns the HTML (as a safe string) for the filter for field_name,
+        using the context data in the dictionary ctx.
+        """
+        raise NotImplementedError()
+
+
+class DjangoTemplateRenderer(Renderer):
+    """
+    Renders using a Django template, which is compiled only once.
+    """
+    def __init__(self, template=None,
+                 template_file="django_easyfilters/default.html"):
+        self.template = template
+        self.template_file = template_file
+        self._compiled = None
+        self._lock = threading.Lock()
+
+    def get_template(self, field_name):
+        if self._compiled is None:
+            with self._lock:
+                if self._compiled is None:
+                    if self.template:
+                        self._compiled = template.Template(self.template)
+                    else:
+                        self._compiled = get_template(self.template_file)
+        return self._compiled
+
+    def render(self, field_name, ctx):
+        return self.get_template(field_name).render(template.Context(ctx))
+
+
+class Jinja2Renderer(Renderer):
+    """
+    Renders using a Jinja2 template. By default the source of the default
+    Django template is used, which is also valid Jinja2.
+
+    Requires Jinja2 to be installed.
+    """
+    def __init__(self, template_source=None, environment=None):
+        try:
+            import jinja2
+        except ImportError:
+            raise ImproperlyConfigured("Jinja2Renderer requires Jinja2 to be "
+                                       "installed")
+        try:
+            from markupsafe import Markup
+        except ImportError:
+            Markup = jinja2.Markup
+        self.markup = Markup
+        if environment is None:
+            environment = jinja2.Environment(autoescape=True)
+        if template_source is None:
+            with io.open(DEFAULT_TEMPLATE_PATH, encoding='utf-8') as f:
+                template_source = f.read()
+        self.template = environment.from_string(template_source)
+
+    def render(self, field_name, ctx):
+        # Labels are already escaped, but older Django versions don't mark
+        # safe strings in a way that Jinja2 understands.
+        choices = [dict(c, label=self.markup(c['label']))
+                   for c in ctx['choices']]
+        return mark_safe(self.template.render(dict(ctx, choices=choices)))
+
+
+class StringRenderer(Renderer):
+    """
+    Renders the same markup as the default template, using plain Python string
+    operations.
+    """
+    def render(self, field_name, ctx):
+        out = [u'<div class="filterline"><span class="filterlabel">%s:</span>'
+               % escape(ctx['filterlabel'])]
+        for choice in ctx['choices']:
+            link_type = choice['link_type']
+            if link_type == 'add':
+                out.append(u'<span class="addfilter"><a href="%s" '
+                           u'title="Add filter">%s&nbsp;(%s)</a></span>'
+                           u'&nbsp;&nbsp;'
+                           % (escape(choice['url']), choice['label'],
+                              escape(choice['count'])))
+            elif link_type == 'remove':
+                out.append(u'<span class="removefilter"><a href="%s" '
+                           u'title="Remove filter">%s&nbsp;&laquo;&nbsp;</a>'
+                           u'</span>'
+                           % (escape(choice['url']), choice['label']))
+            elif link_type == 'more':
+                out.append(u'<span class="morefilter"><a href="%s" '
+                           u'title="More choices">%s</a></span>'
+                           % (escape(choice['url']), choice['label']))
+            else:
+                out.append(u'<span class="displayfilter">%s</span>'
+                           % choice['label'])
+        out.append(u'</div>')
+        return mark_safe(u'\n'.join(out))
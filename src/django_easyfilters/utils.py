@@ -5,6 +5,23 @@ except ImportError:  # Django < 1.5 fallback
 from django.db.models.related import RelatedObject
 from six import PY3
 
+try:
+    from django.utils.functional import cached_property
+except ImportError:
+    class cached_property(object):
+        """
+        Decorator that converts a method with a single self argument into a
+        property cached on the instance.
+        """
+        def __init__(self, func):
+            self.func = func
+
+        def __get__(self, instance, type=None):
+            if instance is None:
+                return self
+            res = instance.__dict__[self.func.__name__] = self.func(instance)
+            return res
+
 
 def python_2_unicode_compatible(klass):  # Copied from Django 1.5
     """
@@ -20,7 +37,19 @@ def python_2_unicode_compatible(klass):  # Copied from Django 1.5
     return klass
 
 
+_model_field_cache = {}
+
+
 def get_model_field(model, f):
+    """
+    Returns (field object, m2m) for the field path f on model. The result is
+    cached, since it is static for the life of the process.
+    """
+    key = (model, f)
+    try:
+        return _model_field_cache[key]
+    except KeyError:
+        pass
     parts = f.split(LOOKUP_SEP)
     opts = model._meta
     for name in parts[:-1]:
@@ -32,4 +61,5 @@ def get_model_field(model, f):
             model = rel.rel.to
             opts = model._meta
     rel, model, direct, m2m = opts.get_field_by_name(parts[-1])
-    return rel, m2m
+    result = _model_field_cache[key] = rel, m2m
+    return result
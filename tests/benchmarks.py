@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+"""
+Micro-benchmarks for parts of django-easyfilters that don't need a database.
+
+Run from the 'tests' directory, with django_easyfilters on the Python path:
+
+    python benchmarks.py
+"""
+from __future__ import print_function
+
+import os
+import sys
+import timeit
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'test_project.settings')
+
+import django
+if hasattr(django, 'setup'):
+    django.setup()
+
+from django_easyfilters.filterset import non_breaking_spaces
+from django_easyfilters.renderers import DjangoTemplateRenderer
+from django_easyfilters.renderers import Jinja2Renderer
+from django_easyfilters.renderers import StringRenderer
+
+
+def make_ctx(num_choices):
+    choices = [dict(label=non_breaking_spaces(u'Choice number %d' % i),
+                    url=u'?field=%d&other=x&another=y' % i,
+                    link_type='add',
+                    count=i)
+               for i in range(num_choices)]
+    return {'filterlabel': u'Field', 'choices': choices}
+
+
+def bench_renderers(num_choices=500, number=200):
+    ctx = make_ctx(num_choices)
+    renderers = [('django', DjangoTemplateRenderer()),
+                 ('string', StringRenderer())]
+    try:
+        renderers.append(('jinja2', Jinja2Renderer()))
+    except Exception as e:
+        print("Skipping jinja2: %s" % e)
+
+    print("Rendering a filter with %d choices, %d times:"
+          % (num_choices, number))
+    for name, renderer in renderers:
+        t = timeit.timeit(lambda: renderer.render('field', ctx), number=number)
+        print("  %-10s %.3fs" % (name, t))
+
+
+def bench_urls(num_choices=500, num_params=30, number=20):
+    from django.http import QueryDict
+    from django_easyfilters.filters import ValuesFilter
+    from test_app.models import Book
+
+    query = '&'.join('param%d=some%%20value%d' % (i, i)
+                     for i in range(num_params))
+    filter_ = ValuesFilter('edition', Book, QueryDict(query))
+
+    def old():
+        for i in range(num_choices):
+            params = filter_.params.copy()
+            params.setlist('edition', [str(i)])
+            params.pop('page', None)
+            params.urlencode()
+
+    def new():
+        for i in range(num_choices):
+            filter_.urlencode_params(filter_.build_params(add=i))
+
+    print("Building URLs for %d choices with %d other params, %d times:"
+          % (num_choices, num_params, number))
+    for name, func in [('old', old), ('new', new)]:
+        t = timeit.timeit(func, number=number)
+        print("  %-10s %.3fs" % (name, t))
+
+
+def main():
+    bench_renderers()
+    bench_urls()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -54,6 +54,20 @@ class Book(models.Model):
         return self.name
 
 
+@python_2_unicode_compatible
 class Person(models.Model):
     date_of_birth = models.DateField()
     name = models.CharField(max_length=50)
+    friends = models.ManyToManyField('self', blank=True)
+
+    def __str__(self):
+        return self.name
+
+
+@python_2_unicode_compatible
+class Event(models.Model):
+    name = models.CharField(max_length=50)
+    start = models.DateTimeField(null=True, blank=True)
+
+    def __str__(self):
+        return self.name
@@ -1,2 +1,3 @@
-from .test_filterset import *
+from .test_caching import *
+from .test_filterset import *
 from .test_ranges import *
\ No newline at end of file
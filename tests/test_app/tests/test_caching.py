@@ -0,0 +1,104 @@
+from decimal import Decimal
+import time
+import unittest
+
+from django.db.models import signals
+from django.test import TestCase
+from django.utils.datastructures import MultiValueDict
+
+from django_easyfilters.caching import FacetCache
+from django_easyfilters.caching import LRUCache
+from django_easyfilters.filters import ValuesFilter
+
+from test_app.models import Book, Event
+
+
+class TestLRUCache(unittest.TestCase):
+
+    def test_max_size(self):
+        cache = LRUCache(max_size=2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        # Use 'a', so that 'b' is the least recently used
+        self.assertEqual(cache.get('a'), 1)
+        cache.set('c', 3)
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.get('b'), None)
+        self.assertEqual(cache.get('c'), 3)
+
+    def test_timeout(self):
+        cache = LRUCache(timeout=-1)
+        cache.set('a', 1)
+        self.assertEqual(cache.get('a', 'missing'), 'missing')
+
+
+class TestFacetCache(TestCase):
+
+    fixtures = ['django_easyfilters_tests']
+
+    def setUp(self):
+        self.cache = FacetCache(key_prefix='easyfilters-test-%s' % time.time())
+
+    def test_counts_cached(self):
+        qs = Book.objects.all()
+        filter1 = ValuesFilter('edition', Book, MultiValueDict(),
+                               cache=self.cache)
+        choices1 = filter1.get_choices(qs)
+
+        filter2 = ValuesFilter('edition', Book, MultiValueDict(),
+                               cache=self.cache)
+        with self.assertNumQueries(0):
+            choices2 = filter2.get_choices(qs)
+        self.assertEqual(choices1, choices2)
+
+    def test_invalidated_on_save(self):
+        qs = Book.objects.all()
+        filter1 = ValuesFilter('edition', Book, MultiValueDict(),
+                               cache=self.cache)
+        choices1 = filter1.get_choices(qs)
+
+        book = Book.objects.filter(edition__isnull=False)[0]
+        book.edition = 1000
+        book.save()
+
+        filter2 = ValuesFilter('edition', Book, MultiValueDict(),
+                               cache=self.cache)
+        choices2 = filter2.get_choices(qs)
+        self.assertNotEqual(choices1, choices2)
+        self.assertTrue('1000' in [c.label for c in choices2])
+
+    def test_invalidated_for_other_processes(self):
+        # Counts cached by another process are invalidated by a save in this
+        # one, which has used the table.
+        qs = Book.objects.all()
+        filter1 = ValuesFilter('edition', Book, MultiValueDict(),
+                               cache=self.cache)
+        choices1 = filter1.get_choices(qs)
+
+        Book.objects.create(name='New', price=Decimal('1.00'), edition=1000)
+
+        # A FacetCache with its own in-process cache, as in another process.
+        other_cache = FacetCache(key_prefix=self.cache.key_prefix)
+        filter2 = ValuesFilter('edition', Book, MultiValueDict(),
+                               cache=other_cache)
+        choices2 = filter2.get_choices(qs)
+        self.assertNotEqual(choices1, choices2)
+        self.assertTrue('1000' in [c.label for c in choices2])
+
+    def test_unused_tables_not_invalidated(self):
+        # Saving models whose tables no count query has used does not touch
+        # the caches.
+        invalidated = []
+        self.cache.invalidate = invalidated.append
+        Event.objects.create(name='New')
+        self.assertEqual(invalidated, [])
+
+        ValuesFilter('name', Event, MultiValueDict(),
+                     cache=self.cache).get_choices(Event.objects.all())
+        Event.objects.create(name='New')
+        self.assertEqual(invalidated, [Event._meta.db_table])
+
+    def test_signals_connected_once(self):
+        num_receivers = len(signals.post_save.receivers)
+        FacetCache(key_prefix='easyfilters-test-other-%s' % time.time())
+        self.assertEqual(len(signals.post_save.receivers), num_receivers)
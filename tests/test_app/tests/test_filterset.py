@@ -1,21 +1,103 @@
 # -*- coding: utf-8; -*-
 
-from datetime import datetime, date
+from datetime import datetime, date, timedelta, tzinfo
 from decimal import Decimal
 import operator
 import re
+import time
 
+from django import VERSION
+from django.db import connections
 from django.http import QueryDict
 from django.test import TestCase
 from django.utils.datastructures import MultiValueDict
 from six import text_type
 
+try:
+    from concurrent import futures
+except ImportError:  # Python 2 without the 'futures' backport
+    futures = None
+
+from django_easyfilters import backends
+from django_easyfilters import memory
+from django_easyfilters import queries
+from django_easyfilters.caching import FacetCache
+from django_easyfilters.caching import LRUCache
+from django_easyfilters.queries import date_aggregation
+from django_easyfilters.queries import normalize_queryset
+from django_easyfilters.queries import numeric_range_counts
+from django_easyfilters.ranges import auto_ranges
+from django_easyfilters.ranges import uniform_step
 from django_easyfilters.filterset import FilterSet
+from django_easyfilters.renderers import DjangoTemplateRenderer
+from django_easyfilters.renderers import Jinja2Renderer
+from django_easyfilters.renderers import StringRenderer
+from django_easyfilters.filters import estimate_count
 from django_easyfilters.filters import \
-    FILTER_ADD, FILTER_REMOVE, FILTER_DISPLAY, \
+    FILTER_ADD, FILTER_REMOVE, FILTER_DISPLAY, FILTER_MORE, \
     ForeignKeyFilter, ValuesFilter, ChoicesFilter, ManyToManyFilter, DateTimeFilter, NumericRangeFilter
 
-from test_app.models import Book, Genre, Author, BINDING_CHOICES, Person
+from test_app.models import Book, Genre, Author, BINDING_CHOICES, Person, \
+    Event
+
+
+class FixedOffset(tzinfo):
+    def __init__(self, hours):
+        self.offset = timedelta(hours=hours)
+
+    def utcoffset(self, dt):
+        return self.offset
+
+    def dst(self, dt):
+        return timedelta(0)
+
+    def tzname(self, dt):
+        return None
+
+
+class DummyExecutor(object):
+    submitted = 0
+
+    def submit(self, func, *args):
+        self.submitted += 1
+        raise AssertionError("Should not be called")
+
+
+class InlineExecutor(object):
+    """
+    An executor that runs functions straight away, in the current thread, so
+    that they can see the test data.
+    """
+    def __init__(self):
+        self.submitted = 0
+
+    def submit(self, func, *args):
+        self.submitted += 1
+        future = futures.Future()
+        try:
+            future.set_result(func(*args))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+
+
+class RecordClosedConnections(object):
+    """
+    Replaces the connections closed by worker threads with one that records
+    how many times it is closed, so that the test database connection stays
+    open.
+    """
+    closed = 0
+
+    def __enter__(self):
+        connections.all = lambda: [self]
+        return self
+
+    def __exit__(self, *exc_info):
+        del connections.all
+
+    def close(self):
+        self.closed += 1
 
 
 class TestFilterSet(TestCase):
@@ -57,6 +139,27 @@ class TestFilterSet(TestCase):
 
         self.assertTrue('Genre' in rendered_2)
 
+    def test_filterset_iter_render(self):
+        class BookFilterSet(FilterSet):
+            fields = [
+                'genre',
+                'binding',
+                ]
+
+        qs = Book.objects.all()
+        fs = BookFilterSet(qs, QueryDict(''))
+        rendered = fs.iter_render()
+        first = next(rendered)
+        self.assertTrue('Genre' in first)
+        # Only the first filter has been done so far
+        self.assertEqual(list(fs._cached_filter_choices.keys()), ['genre'])
+        self.assertEqual(u'\n'.join([first] + list(rendered)), fs.render())
+
+        # Can choose order
+        parts = list(fs.iter_render(['binding', 'genre']))
+        self.assertTrue('Binding' in parts[0])
+        self.assertTrue('Genre' in parts[1])
+
     def test_custom_template(self):
         class BookFilterSet(FilterSet):
             template_file = "ignore/this/non-existent/file"
@@ -85,6 +188,36 @@ class TestFilterSet(TestCase):
         self.assertEqual(rendered, text_type(fs))
 
 
+    def test_renderers(self):
+        class BookFilterSet(FilterSet):
+            fields = [
+                'genre',
+                'binding',
+                'authors',
+                ('edition', dict(limit=1)),
+                ]
+
+        def normalize(html):
+            return re.sub(r'\s*\n\s*', '', html)
+
+        qs = Book.objects.all()
+        data = QueryDict('authors=2')
+        expected = normalize(BookFilterSet(qs, data).render())
+        renderer_classes = [DjangoTemplateRenderer, StringRenderer]
+        try:
+            import jinja2
+            renderer_classes.append(Jinja2Renderer)
+        except ImportError:
+            pass
+
+        for renderer_class in renderer_classes:
+            class RenderedBookFilterSet(BookFilterSet):
+                renderer = renderer_class()
+
+            rendered = RenderedBookFilterSet(qs, data).render()
+            self.assertEqual(normalize(rendered), expected,
+                             "%s gives different output" % renderer_class)
+
     def test_get_filter_for_field(self):
         """
         Ensures that the get_filter_for_field method chooses appropriately.
@@ -109,6 +242,47 @@ class TestFilterSet(TestCase):
         self.assertEqual(NumericRangeFilter, type(fs.filters[5]))
         self.assertEqual(NumericRangeFilter, type(fs.filters[6]))
 
+    def test_filter_specs_shared(self):
+        class BookFilterSet(FilterSet):
+            fields = [
+                'genre',
+                ('price', {'max_links': 3}),
+                ]
+
+        class SubBookFilterSet(BookFilterSet):
+            fields = [
+                'genre',
+                ]
+
+        fs1 = BookFilterSet(Book.objects.all(), QueryDict(''))
+        fs2 = BookFilterSet(Book.objects.all(), QueryDict('genre=1'))
+        self.assertTrue(fs1.get_filter_specs() is fs2.get_filter_specs())
+        self.assertEqual([(s.field_name, s.klass, dict(s.opts), s.label)
+                          for s in fs1.get_filter_specs()],
+                         [('genre', ForeignKeyFilter, {}, 'Genre'),
+                          ('price', NumericRangeFilter, {'max_links': 3},
+                           'Price')])
+        self.assertEqual(fs2.filters[1].max_links, 3)
+
+        fs3 = SubBookFilterSet(Book.objects.all(), QueryDict(''))
+        self.assertEqual(len(fs3.get_filter_specs()), 1)
+        self.assertEqual(len(fs1.get_filter_specs()), 2)
+
+    def test_filter_specs_not_cached(self):
+        class BookFilterSet(FilterSet):
+            cache_filter_specs = False
+
+            def get_fields(self):
+                # Depends on the request
+                if 'genre' in self.params:
+                    return ['genre', 'binding']
+                return ['genre']
+
+        fs1 = BookFilterSet(Book.objects.all(), QueryDict(''))
+        fs2 = BookFilterSet(Book.objects.all(), QueryDict('genre=1'))
+        self.assertEqual([f.field for f in fs1.filters], ['genre'])
+        self.assertEqual([f.field for f in fs2.filters], ['genre', 'binding'])
+
     def test_specify_custom_filter(self):
         class AuthorFilterSet(FilterSet):
             fields = [
@@ -147,6 +321,478 @@ class TestFilterSet(TestCase):
         f = BookFilterSet(qs, data)
         self.assertEqual(f.title, "Classics")
 
+    def test_chosen_objects_bulk_lookup(self):
+        class BookFilterSet(FilterSet):
+            fields = [
+                'genre',
+                'authors',
+                ]
+
+        genre = Genre.objects.get(name='Classics')
+        emily = Author.objects.get(name='Emily Brontë')
+        anne = Author.objects.get(name='Anne Brontë')
+        data = QueryDict('genre=%s&authors=%s&authors=%s&authors=xxx'
+                         % (genre.pk, emily.pk, anne.pk))
+        fs = BookFilterSet(Book.objects.all(), data)
+        with self.assertNumQueries(2):
+            # One query for each related model
+            self.assertEqual(fs.filters[0].chosen, (genre,))
+            self.assertEqual(fs.filters[1].chosen, (emily, anne))
+
+        # With a cache, the objects are reused
+        class CachedBookFilterSet(BookFilterSet):
+            related_objects_cache = LRUCache()
+
+        CachedBookFilterSet(Book.objects.all(), data).filters[0].chosen
+        fs = CachedBookFilterSet(Book.objects.all(), data)
+        with self.assertNumQueries(0):
+            self.assertEqual(fs.filters[0].chosen, (genre,))
+            self.assertEqual(fs.filters[1].chosen, (emily, anne))
+
+    def test_executor(self):
+        class BookFilterSet(FilterSet):
+            fields = [
+                'genre',
+                'binding',
+                'authors',
+                'price',
+                ]
+
+        class ParallelBookFilterSet(BookFilterSet):
+            executor = DummyExecutor()
+
+        qs = Book.objects.all()
+        data = QueryDict('authors=2')
+        fs1 = BookFilterSet(qs, data)
+        fs2 = ParallelBookFilterSet(qs, data)
+        # Test data is not visible to other connections, so only the
+        # serial fallback can be tested here.
+        self.assertFalse(fs2.can_compute_in_parallel())
+        self.assertEqual(fs1.render(), fs2.render())
+        self.assertEqual(ParallelBookFilterSet.executor.submitted, 0)
+
+    def test_executor_parallel(self):
+        if futures is None:
+            # Python 2 without the 'futures' backport
+            return
+
+        class BookFilterSet(FilterSet):
+            fields = [
+                'genre',
+                'binding',
+                'authors',
+                'price',
+                ]
+
+        class ParallelBookFilterSet(BookFilterSet):
+            executor = InlineExecutor()
+            max_parallel_filters = 2
+
+            def can_use_other_threads(self):
+                # The executor uses this thread.
+                return True
+
+        qs = Book.objects.all()
+        data = QueryDict('authors=2')
+        fs1 = BookFilterSet(qs, data)
+        fs2 = ParallelBookFilterSet(qs, data)
+        self.assertTrue(fs2.can_compute_in_parallel())
+        with RecordClosedConnections() as recorder:
+            output = fs2.render()
+        self.assertEqual(output, fs1.render())
+        self.assertEqual(fs2.executor.submitted, 4)
+        self.assertEqual(recorder.closed, 4)
+
+        # Errors are raised by render(), and connections are still closed.
+        class FailingFilter(ChoicesFilter):
+            def get_choices(self, qs):
+                raise ValueError("Failed")
+
+        class FailingBookFilterSet(ParallelBookFilterSet):
+            executor = InlineExecutor()
+            fields = [
+                'genre',
+                ('binding', {}, FailingFilter),
+                ]
+
+        fs3 = FailingBookFilterSet(qs, data)
+        with RecordClosedConnections() as recorder:
+            self.assertRaises(ValueError, fs3.render)
+        self.assertEqual(recorder.closed, fs3.executor.submitted)
+        self.assertTrue(recorder.closed > 0)
+
+    def test_acompute(self):
+        try:
+            import asyncio
+            from django_easyfilters import aio
+        except (ImportError, SyntaxError):
+            # Python < 3.5
+            return
+
+        class BookFilterSet(FilterSet):
+            fields = [
+                'genre',
+                'binding',
+                'authors',
+                'price',
+                ]
+
+        qs = Book.objects.all()
+        data = QueryDict('authors=2')
+        fs1 = BookFilterSet(qs, data)
+        fs2 = BookFilterSet(qs, data)
+        loop = asyncio.new_event_loop()
+        try:
+            choices = loop.run_until_complete(fs2.acompute())
+            self.assertEqual(sorted(choices.keys()),
+                             ['authors', 'binding', 'genre', 'price'])
+            for field, field_choices in choices.items():
+                self.assertEqual(field_choices, fs1.get_filter_choices(field))
+            # Everything has been computed already
+            self.assertNumQueries(0, fs2.render)
+            self.assertEqual(loop.run_until_complete(fs2.arender()),
+                             fs1.render())
+
+            # Test data is not visible to other connections, so the queries
+            # of each filter are done in the current thread by the executor.
+            class ThreadedBookFilterSet(BookFilterSet):
+                executor = InlineExecutor()
+
+                def can_use_other_connections(self):
+                    return True
+
+            fs3 = ThreadedBookFilterSet(qs, data)
+            with RecordClosedConnections() as recorder:
+                choices = loop.run_until_complete(fs3.acompute())
+            for field, field_choices in choices.items():
+                self.assertEqual(field_choices, fs1.get_filter_choices(field))
+            # One for the shared work, and one for each filter.
+            self.assertEqual(fs3.executor.submitted, 5)
+            self.assertEqual(recorder.closed, 5)
+        finally:
+            loop.close()
+
+    def test_combine_counts(self):
+        class BookFilterSet(FilterSet):
+            fields = [
+                'genre',
+                'binding',
+                'authors',
+                'edition',
+                'other',
+                ]
+
+        class CombinedBookFilterSet(BookFilterSet):
+            combine_counts = True
+
+        qs = Book.objects.all()
+        for data in [QueryDict(''), QueryDict('edition=1'),
+                     QueryDict('binding=H&authors=2')]:
+            fs1 = BookFilterSet(qs, data)
+            fs2 = CombinedBookFilterSet(qs, data)
+            for f1, f2 in zip(fs1.filters, fs2.filters):
+                self.assertEqual(fs1.get_filter_choices(f1.field),
+                                 fs2.get_filter_choices(f2.field))
+
+        # Empty QuerySets have no SQL, so give no counts.
+        for empty_qs in [qs.none(), qs.filter(pk__in=[])]:
+            fs = CombinedBookFilterSet(empty_qs, QueryDict(''))
+            for f in fs.filters:
+                self.assertEqual(fs.get_filter_choices(f.field), [])
+            fs.render()
+
+    def test_materialize_base(self):
+        class BookFilterSet(FilterSet):
+            fields = [
+                'genre',
+                'binding',
+                'authors',
+                'price',
+                'date_published',
+                ]
+
+        class MaterializedBookFilterSet(BookFilterSet):
+            materialize_base = True
+            combine_counts = True
+
+        qs = Book.objects.filter(name__icontains='the')
+        for data in [QueryDict(''), QueryDict('authors=2'),
+                     QueryDict('binding=H&genre=1')]:
+            fs1 = BookFilterSet(qs, data)
+            fs2 = MaterializedBookFilterSet(qs, data)
+            self.assertTrue(fs2.use_materialized_base)
+            self.assertFalse(fs2.can_use_other_threads())
+            self.assertEqual(fs1.render(), fs2.render())
+
+    def test_materialize_base_cache(self):
+        # Saving objects that are only used by the conditions of the
+        # materialized QuerySet invalidates the cached counts.
+        class BookFilterSet(FilterSet):
+            fields = ['binding']
+
+        class CachedBookFilterSet(BookFilterSet):
+            materialize_base = True
+            defaults = {'cache': FacetCache(
+                key_prefix='easyfilters-test-%s' % time.time())}
+
+        qs = Book.objects.filter(genre__name='Fantasy')
+        fs1 = CachedBookFilterSet(qs, QueryDict(''))
+        self.assertTrue(fs1.use_materialized_base)
+        output1 = fs1.render()
+
+        genre = Genre.objects.get(name='Romance')
+        genre.name = 'Fantasy'
+        genre.save()
+
+        output2 = CachedBookFilterSet(qs, QueryDict('')).render()
+        self.assertNotEqual(output1, output2)
+        self.assertEqual(output2, BookFilterSet(qs, QueryDict('')).render())
+
+    def test_materialize_base_auto(self):
+        class BookFilterSet(FilterSet):
+            fields = ['genre', 'binding']
+            materialize_base = 'auto'
+
+        data = QueryDict('')
+        self.assertFalse(BookFilterSet(Book.objects.all(), data)
+                         .use_materialized_base)
+        self.assertFalse(BookFilterSet(Book.objects.filter(edition=1), data)
+                         .use_materialized_base)
+        self.assertTrue(BookFilterSet(Book.objects.filter(name__contains='e'),
+                                      data).use_materialized_base)
+        self.assertTrue(BookFilterSet(Book.objects.filter(genre__name='Drama'),
+                                      data).use_materialized_base)
+
+    def test_pks(self):
+        class BookFilterSet(FilterSet):
+            fields = [
+                'genre',
+                'binding',
+                'authors',
+                'price',
+                'date_published',
+                ]
+            combine_counts = True
+
+        pks = list(Book.objects.filter(name__icontains='the')
+                   .values_list('pk', flat=True))
+        for data in [QueryDict(''), QueryDict('authors=2'),
+                     QueryDict('binding=H&genre=1')]:
+            fs1 = BookFilterSet(Book.objects.filter(pk__in=pks), data)
+            fs2 = BookFilterSet(Book.objects.all(), data, pks=iter(pks))
+            self.assertEqual(sorted(b.pk for b in fs1.qs),
+                             sorted(b.pk for b in fs2.qs))
+            self.assertEqual(fs1.render(), fs2.render())
+
+        # No primary keys means no objects, and no count queries.
+        class MaterializedBookFilterSet(BookFilterSet):
+            materialize_base = True
+
+        class ApproximateBookFilterSet(BookFilterSet):
+            approximate = True
+            approximate_threshold = 0
+
+        for filterset_class in [BookFilterSet, MaterializedBookFilterSet,
+                                ApproximateBookFilterSet]:
+            fs = filterset_class(Book.objects.all(), QueryDict(''), pks=[])
+            self.assertEqual(list(fs.qs), [])
+            with self.assertNumQueries(0):
+                fs.render()
+            self.assertTrue(all(fs.get_filter_choices(f.field) == []
+                                for f in fs.filters))
+
+        # Values for counting in memory are fetched using the temporary table
+        # too, rather than the list of primary keys.
+        class SmallBookFilterSet(BookFilterSet):
+            small_result_threshold = 1000
+
+        fs1 = BookFilterSet(Book.objects.filter(pk__in=pks), QueryDict(''))
+        fs2 = SmallBookFilterSet(Book.objects.all(), QueryDict(''), pks=pks)
+        self.assertEqual(fs1.render(), fs2.render())
+        if fs2.use_pk_table:
+            self.assertNotIn('rows', fs2.__dict__)
+
+    def test_approximate(self):
+        class BookFilterSet(FilterSet):
+            fields = [
+                'genre',
+                'binding',
+                'authors',
+                'price',
+                'date_published',
+                ]
+
+        class ApproximateBookFilterSet(BookFilterSet):
+            approximate = True
+            approximate_threshold = 0
+            sample_percent = 100
+
+        qs = Book.objects.all()
+        for data in [QueryDict(''), QueryDict('authors=2')]:
+            fs1 = BookFilterSet(qs, data)
+            fs2 = ApproximateBookFilterSet(qs, data)
+            self.assertEqual(fs2.sample[1], 1.0)
+            for f in fs1.filters:
+                choices1 = fs1.get_filter_choices(f.field)
+                choices2 = fs2.get_filter_choices(f.field)
+                self.assertEqual(choices1, choices2)
+                for c in choices2:
+                    if c.count is not None:
+                        self.assertEqual(text_type(c.count), '~%d' % c.count)
+                        self.assertEqual(c.count.interval,
+                                         (c.count, c.count))
+
+        # Exact counts for small results
+        class SmallBookFilterSet(ApproximateBookFilterSet):
+            approximate_threshold = 1000
+
+        fs = SmallBookFilterSet(qs, QueryDict(''))
+        self.assertEqual(fs.sample, None)
+        self.assertEqual(fs.render(), BookFilterSet(qs, QueryDict('')).render())
+
+        # The estimates aren't replaced with exact counts by the parallel
+        # threads.
+        class ParallelBookFilterSet(ApproximateBookFilterSet):
+            executor = DummyExecutor()
+
+            def can_use_other_threads(self):
+                return True
+
+        fs = ParallelBookFilterSet(qs, QueryDict(''))
+        fs2 = ApproximateBookFilterSet(qs, QueryDict(''))
+        self.assertEqual(fs.render(), fs2.render())
+        self.assertEqual(fs.executor.submitted, 0)
+
+    def test_approximate_sample(self):
+        class BookFilterSet(FilterSet):
+            fields = ['genre', 'binding']
+            approximate = True
+            approximate_threshold = 0
+            sample_percent = 50
+            sample_seed = 1
+
+        qs = Book.objects.all()
+        fs = BookFilterSet(qs, QueryDict(''))
+        sample_qs, fraction = fs.sample
+        self.assertTrue(0 < fraction < 1)
+        pks = set(sample_qs.values_list('pk', flat=True))
+        self.assertTrue(0 < len(pks) < qs.count())
+        # Each query, and each filterset with the same seed, sees the same
+        # sample.
+        self.assertEqual(set(sample_qs.values_list('pk', flat=True)), pks)
+        fs2 = BookFilterSet(qs, QueryDict(''))
+        self.assertEqual(set(fs2.sample[0].values_list('pk', flat=True)), pks)
+
+        for f in fs.filters:
+            choices = fs.get_filter_choices(f.field)
+            self.assertEqual(choices, fs2.get_filter_choices(f.field))
+            self.assertTrue(choices)
+            for c in choices:
+                sample_count = f.__class__(f.field, Book, c.params)\
+                    .apply_filter(sample_qs).count()
+                self.assertEqual(c.count,
+                                 int(round(sample_count / fraction)))
+                self.assertTrue(c.count.low <= c.count <= c.count.high)
+
+    def test_estimate_count(self):
+        count = estimate_count(10, 0.1)
+        self.assertEqual(count, 100)
+        self.assertEqual(count.interval, (41, 159))
+        self.assertEqual(estimate_count(5, 0.5).interval, (5, 17))
+        # The interval is wider for samples of blocks of rows.
+        self.assertEqual(estimate_count(10, 0.1, design_effect=4).interval,
+                         (10, 218))
+
+    def test_small_result_threshold(self):
+        class BookFilterSet(FilterSet):
+            fields = [
+                'genre',
+                'binding',
+                'authors',
+                'price',
+                'date_published',
+                'rating',
+                ('edition', dict(limit=2)),
+                ]
+
+        class SmallBookFilterSet(BookFilterSet):
+            small_result_threshold = 1000
+
+        qs = Book.objects.all()
+        for data in [QueryDict(''), QueryDict('authors=2'),
+                     QueryDict('binding=H&genre=1'),
+                     QueryDict('date_published=1818')]:
+            fs1 = BookFilterSet(qs, data)
+            fs2 = SmallBookFilterSet(qs, data)
+            self.assertNotEqual(fs2.rows, None)
+            for f in fs1.filters:
+                self.assertEqual(fs1.get_filter_choices(f.field),
+                                 fs2.get_filter_choices(f.field))
+
+        # One query to check the size, and one to fetch the values.
+        class SimpleBookFilterSet(SmallBookFilterSet):
+            fields = ['binding', 'edition', 'price', 'date_published']
+
+        fs = SimpleBookFilterSet(qs, QueryDict(''))
+        with self.assertNumQueries(2):
+            for f in fs.filters:
+                fs.get_filter_choices(f.field)
+
+        # Too many results
+        class TinyBookFilterSet(BookFilterSet):
+            small_result_threshold = 0
+
+        fs = TinyBookFilterSet(qs, QueryDict(''))
+        self.assertEqual(fs.rows, None)
+        self.assertEqual(fs.render(), BookFilterSet(qs, QueryDict('')).render())
+
+    def check_datetime_counts(self, tz):
+        Event.objects.all().delete()
+        for start in [datetime(2011, 12, 31, 23, 30), datetime(2012, 1, 1),
+                      datetime(2012, 1, 1, 12, 15), datetime(2012, 3, 5, 6),
+                      None]:
+            if start is not None and tz is not None:
+                start = start.replace(tzinfo=tz)
+            Event.objects.create(name='Event', start=start)
+        qs = Event.objects.all()
+        rows = memory.FacetRows(qs, ['start'])
+        for kind in ['year', 'month', 'day']:
+            expected = queries.date_counts(qs, 'start', kind)
+            self.assertEqual(len(expected), {'year': 2, 'month': 3,
+                                             'day': 3}[kind])
+            self.assertEqual(set(d.tzinfo is None for d, count in expected),
+                             set([tz is None]))
+            self.assertEqual(memory.date_counts(rows, 'start', kind),
+                             expected)
+
+        class EventFilterSet(FilterSet):
+            fields = ['start']
+
+        class SmallEventFilterSet(EventFilterSet):
+            small_result_threshold = 1000
+
+        for data in [QueryDict(''), QueryDict('start=2012')]:
+            self.assertEqual(EventFilterSet(qs, data).render(),
+                             SmallEventFilterSet(qs, data).render())
+
+    def test_small_result_threshold_datetimes(self):
+        # Values of DateTimeFields are truncated in memory as the database
+        # does, giving aware datetimes if USE_TZ is True: in UTC before Django
+        # 1.6, and in the current time zone from then on.
+        self.check_datetime_counts(None)
+        if VERSION >= (1, 6):
+            try:
+                import pytz
+            except ImportError:  # Needed by Django for time zones in queries
+                return
+            from django.utils import timezone
+            with self.settings(USE_TZ=True):
+                with timezone.override(pytz.timezone('Europe/Paris')):
+                    self.check_datetime_counts(FixedOffset(2))
+        elif VERSION >= (1, 4):
+            with self.settings(USE_TZ=True):
+                self.check_datetime_counts(FixedOffset(2))
+
 
 class TestFilters(TestCase):
     fixtures = ['django_easyfilters_tests']
@@ -216,6 +862,63 @@ class TestFilters(TestCase):
         self.assertTrue(reached[0])
         self.assertTrue(reached[1])
 
+    def test_foreignkey_null_count(self):
+        """
+        The count for NULL comes from the same query as the other counts.
+        """
+        filter_ = ForeignKeyFilter('genre', Book, MultiValueDict())
+        qs = Book.objects.all()
+        null_count = qs.filter(genre__isnull=True).count()
+        self.assertTrue(null_count > 0)
+
+        with self.assertNumQueries(2):
+            # 1 query for counts, 1 for the related objects
+            choices = filter_.get_choices(qs)
+        self.assertEqual(choices[0].label, '(null)')
+        self.assertEqual(choices[0].count, null_count)
+        self.assertEqual(sum(c.count for c in choices), qs.count())
+
+    def test_foreignkey_label_field(self):
+        qs = Book.objects.all()
+        filter1 = ForeignKeyFilter('genre', Book, MultiValueDict())
+        filter2 = ForeignKeyFilter('genre', Book, MultiValueDict(),
+                                   label_field='name')
+        with self.assertNumQueries(1):
+            # Counts and labels in one query
+            choices = filter2.get_choices(qs)
+        self.assertEqual([(c.label, c.count, sorted(c.params.lists()))
+                          for c in choices],
+                         [(c.label, c.count, sorted(c.params.lists()))
+                          for c in filter1.get_choices(qs)])
+
+        # Chosen values have labels too, without loading model instances.
+        genre = Genre.objects.get(name='Classics')
+        filter3 = ForeignKeyFilter('genre', Book,
+                                   MultiValueDict({'genre': [str(genre.pk)]}),
+                                   label_field='name')
+        with self.assertNumQueries(1):
+            choices = filter3.get_choices(filter3.apply_filter(qs))
+        self.assertEqual(choices[0].label, 'Classics')
+        self.assertEqual(choices[0].link_type, FILTER_REMOVE)
+        self.assertEqual(dict(choices[0].params.lists()), {})
+
+    def test_normalize_queryset(self):
+        qs = Author.objects.select_related().distinct()
+        normalized = normalize_queryset(qs)
+        self.assertFalse(normalized.ordered)
+        self.assertFalse(normalized.query.select_related)
+        self.assertFalse(normalized.query.distinct)
+        self.assertEqual(sorted(a.pk for a in normalized),
+                         sorted(a.pk for a in qs))
+        # The original is not changed
+        self.assertTrue(qs.ordered)
+        self.assertTrue(qs.query.distinct)
+
+        # DISTINCT is needed if there are joins
+        qs = Book.objects.filter(authors__name__contains='e').distinct()
+        self.assertTrue(normalize_queryset(qs).query.distinct)
+        self.assertEqual(normalize_queryset(qs).count(), qs.count())
+
     def test_foreignkey_params_produced(self):
         """
         A ForeignKey filter shoud produce params that cause the query to be
@@ -264,6 +967,20 @@ class TestFilters(TestCase):
         qs_reverted = filter3.apply_filter(qs)
         self.assertEqual(qs, qs_reverted)
 
+    def test_foreignkey_lazy_chosen(self):
+        """
+        A ForeignKeyFilter should be able to filter without looking up the
+        chosen objects.
+        """
+        genre = Genre.objects.get(name='Classics')
+        data = MultiValueDict({'genre': [str(genre.pk)]})
+        qs = Book.objects.all()
+        with self.assertNumQueries(0):
+            filter1 = ForeignKeyFilter('genre', Book, data)
+            qs_filtered = filter1.apply_filter(qs)
+        self.assertEqual(list(qs_filtered), list(qs.filter(genre=genre)))
+        self.assertEqual(filter1.chosen, (genre,))
+
     def test_foreignkey_invalid_query(self):
         self.do_invalid_query_param(lambda params:
                                              ForeignKeyFilter('genre', Book, params),
@@ -302,6 +1019,118 @@ class TestFilters(TestCase):
         self.assertEqual([text_type(v) if v else '(null)' for v in Book.objects.values_list('edition', flat=True).order_by('edition').distinct()],
                          [choice.label for choice in choices])
 
+    def test_values_filter_limit(self):
+        qs = Book.objects.all()
+        choices = ValuesFilter('edition', Book, MultiValueDict())\
+            .get_choices(qs)
+        expected = dict((c.label, c.count) for c in choices)
+
+        # Follow the 'more' links to get all the choices.
+        found = {}
+        params = MultiValueDict()
+        counts = []
+        while True:
+            filter1 = ValuesFilter('edition', Book, params, limit=1)
+            choices = filter1.get_choices(qs)
+            more = [c for c in choices if c.link_type == FILTER_MORE]
+            for choice in choices:
+                if choice.link_type == FILTER_ADD:
+                    found[choice.label] = choice.count
+                    if choice.label != '(null)':
+                        counts.append(choice.count)
+            self.assertTrue(len([c for c in choices
+                                 if c.label != '(null)']) <= 2)
+            if not more:
+                break
+            params = more[0].params
+        self.assertEqual(found, expected)
+        # In order of count
+        self.assertEqual(counts, sorted(counts, reverse=True))
+
+        filter2 = ValuesFilter('edition', Book, MultiValueDict(), min_count=2)
+        self.assertEqual(dict((c.label, c.count)
+                              for c in filter2.get_choices(qs)),
+                         dict((label, count)
+                              for label, count in expected.items()
+                              if count >= 2))
+
+        # If only one value has min_count, it can still be chosen, since
+        # other values were left out.
+        top_count = max(expected.values())
+        self.assertTrue(len(expected) > 1)
+        filter3 = ValuesFilter('edition', Book, MultiValueDict(),
+                               min_count=top_count)
+        choices = filter3.get_choices(qs)
+        self.assertEqual(len(choices), 1)
+        self.assertEqual(choices[0].link_type, FILTER_ADD)
+
+        # But not if that is the only value.
+        qs_one = Book.objects.filter(edition=1)
+        filter4 = ValuesFilter('edition', Book, MultiValueDict(), min_count=1)
+        choices = filter4.get_choices(qs_one)
+        self.assertEqual(len(choices), 1)
+        self.assertEqual(choices[0].link_type, FILTER_DISPLAY)
+
+    def test_foreignkey_limit(self):
+        qs = Book.objects.all()
+        filter1 = ForeignKeyFilter('genre', Book, MultiValueDict(), limit=2)
+        filter2 = ForeignKeyFilter('genre', Book, MultiValueDict(), limit=2,
+                                   label_field='name')
+        choices1 = filter1.get_choices(qs)
+        choices2 = filter2.get_choices(qs)
+        self.assertEqual(choices1, choices2)
+        self.assertEqual(choices1[-1].link_type, FILTER_MORE)
+        add_choices = [c for c in choices1 if c.link_type == FILTER_ADD]
+        # Sorted by name, as normal
+        self.assertEqual(add_choices, sorted(add_choices,
+                                             key=operator.attrgetter('label')))
+        all_counts = sorted((c.count for c in
+                             ForeignKeyFilter('genre', Book, MultiValueDict())
+                             .get_choices(qs)
+                             if c.label != '(null)'), reverse=True)
+        self.assertEqual(sorted((c.count for c in add_choices
+                                 if c.label != '(null)'), reverse=True),
+                         all_counts[:2])
+
+    def test_count_cap(self):
+        qs = Book.objects.all()
+        for field, filter_class in [('binding', ChoicesFilter),
+                                    ('genre', ForeignKeyFilter)]:
+            choices1 = filter_class(field, Book, MultiValueDict())\
+                .get_choices(qs)
+            choices2 = filter_class(field, Book, MultiValueDict(),
+                                    count_cap=2).get_choices(qs)
+            self.assertEqual([c.label for c in choices1],
+                             [c.label for c in choices2])
+            self.assertTrue(any(c.count > 2 for c in choices1))
+            for c1, c2 in zip(choices1, choices2):
+                if c1.count > 2:
+                    self.assertEqual(c2.count, 2)
+                    self.assertEqual(text_type(c2.count), '2+')
+                else:
+                    self.assertEqual(c2.count, c1.count)
+                    self.assertEqual(text_type(c2.count), text_type(c1.count))
+
+        # The possible values of a ValuesFilter are not known, so it counts
+        # in full.
+        choices1 = ValuesFilter('edition', Book, MultiValueDict())\
+            .get_choices(qs)
+        choices2 = ValuesFilter('edition', Book, MultiValueDict(),
+                                count_cap=2).get_choices(qs)
+        self.assertEqual([(c.label, c.count) for c in choices1],
+                         [(c.label, c.count) for c in choices2])
+
+        # Nothing is counted without show_counts or order_by_count.
+        self.assertEqual(ChoicesFilter('binding', Book, MultiValueDict(),
+                                       count_cap=2, show_counts=False)
+                         .get_capped_values(qs), None)
+
+        class BookFilterSet(FilterSet):
+            fields = ['genre']
+            defaults = {'count_cap': 2}
+
+        self.assertIn('2+', BookFilterSet(qs, QueryDict('')).render())
+
     def test_choices_filter(self):
         """
         Tests for ChoicesFilter
@@ -383,6 +1212,43 @@ class TestFilters(TestCase):
             choices_filtered = filter2.get_choices(qs)
             self.assertEqual(choices_filtered[0].link_type, FILTER_REMOVE)
 
+    def test_manytomany_count_strategies(self):
+        qs = Book.objects.all()
+        emily = Author.objects.get(name='Emily Brontë')
+        data = MultiValueDict({'authors': [str(emily.pk)]})
+        f = ManyToManyFilter('authors', Book, data, count_strategy='in')
+        expected = f.get_choices(f.apply_filter(qs))
+        for strategy in ['exists', 'join', 'auto']:
+            f = ManyToManyFilter('authors', Book, data,
+                                 count_strategy=strategy)
+            self.assertEqual(f.get_choices(f.apply_filter(qs)),
+                             expected)
+
+    def test_manytomany_self_referential(self):
+        joe = Person.objects.create(name="Joe", date_of_birth=date(2011, 1, 10))
+        peter = Person.objects.create(name="Peter", date_of_birth=date(2011, 1, 20))
+        anne = Person.objects.create(name="Anne", date_of_birth=date(2011, 1, 30))
+        joe.friends.add(peter, anne)
+
+        qs = Person.objects.all()
+        for strategy in ['in', 'exists', 'join']:
+            f = ManyToManyFilter('friends', Person, MultiValueDict(),
+                                 count_strategy=strategy)
+            # The relation is symmetrical, so Joe is a friend of two people.
+            self.assertEqual(sorted((c.label, c.count)
+                                    for c in f.get_choices(qs)),
+                             [('Anne', 1), ('Joe', 2), ('Peter', 1)])
+
+            f = ManyToManyFilter('friends', Person,
+                                 MultiValueDict({'friends': [str(peter.pk)]}),
+                                 count_strategy=strategy)
+            qs_filtered = f.apply_filter(qs)
+            self.assertEqual(list(qs_filtered), [joe])
+            self.assertEqual([(c.label, c.count, c.link_type)
+                              for c in f.get_choices(qs_filtered)],
+                             [('Peter', None, FILTER_REMOVE),
+                              ('Anne', 1, FILTER_DISPLAY)])
+
     def test_manytomany_filter_multiple(self):
         qs = Book.objects.all()
 
@@ -394,12 +1260,12 @@ class TestFilters(TestCase):
         # If we select 'emily' as an author:
 
         data =  MultiValueDict({'authors':[str(emily.pk)]})
-        with self.assertNumQueries(1):
-            # 1 query for all chosen objects
+        with self.assertNumQueries(0):
+            # Chosen objects are not looked up until needed
             filter1 = ManyToManyFilter('authors', Book, data)
 
         with self.assertNumQueries(0):
-            # This shouldn't need to do any more queries
+            # Filtering is done on the PKs, so no queries here either
             qs_emily = filter1.apply_filter(qs)
 
         # ...we should get a qs that includes Poems and Wuthering Heights.
@@ -409,7 +1275,7 @@ class TestFilters(TestCase):
         self.assertFalse(qs_emily.filter(name='Jane Eyre').exists())
 
         with self.assertNumQueries(3):
-            # 0 query for all chosen objects (already done)
+            # 1 query for all chosen objects
             # 1 query for available objects
             # 1 query for counts
             choices = filter1.get_choices(qs_emily)
@@ -448,6 +1314,22 @@ class TestFilters(TestCase):
                           (text_type(anne), FILTER_REMOVE),
                           (text_type(charlotte), FILTER_DISPLAY)])
 
+    def test_manytomany_label_field(self):
+        qs = Book.objects.all()
+        emily = Author.objects.get(name='Emily Brontë')
+        data = MultiValueDict({'authors': [str(emily.pk)]})
+        filter1 = ManyToManyFilter('authors', Book, data)
+        filter2 = ManyToManyFilter('authors', Book, data, label_field='name')
+        qs_emily = filter1.apply_filter(qs)
+        with self.assertNumQueries(2):
+            # 1 query for the labels of chosen objects, 1 for counts and labels
+            choices = filter2.get_choices(qs_emily)
+        self.assertEqual(choices[0].label, text_type(emily))
+        self.assertEqual(sorted((c.label, c.count, sorted(c.params.lists()))
+                                for c in choices),
+                         sorted((c.label, c.count, sorted(c.params.lists()))
+                                for c in filter1.get_choices(qs_emily)))
+
     def test_manytomany_filter_invalid_query(self):
         self.do_invalid_query_param(lambda params:
                                              ManyToManyFilter('authors', Book, params),
@@ -606,6 +1488,91 @@ class TestFilters(TestCase):
 
         self.assertTrue("16" in [c.label for c in add_choices])
 
+    def test_datetime_filter_histogram(self):
+        """
+        If the dates span a limited number of days, all the levels are worked
+        out from a single query for the counts per day.
+        """
+        Person.objects.create(name="Joe", date_of_birth=date(2011, 1, 10))
+        Person.objects.create(name="Peter", date_of_birth=date(2011, 1, 20))
+        Person.objects.create(name="Anne", date_of_birth=date(2011, 1, 20))
+        qs = Person.objects.all()
+
+        for params, num_queries in [(MultiValueDict(), 2),
+                                    (MultiValueDict({'date_of_birth': ['2011']}), 1)]:
+            f1 = DateTimeFilter('date_of_birth', Person, params,
+                                max_histogram_days=0)
+            f2 = DateTimeFilter('date_of_birth', Person, params)
+            qs_filtered = f1.apply_filter(qs)
+            with self.assertNumQueries(num_queries):
+                choices = f2.get_choices(qs_filtered)
+            self.assertEqual(choices, f1.get_choices(qs_filtered))
+            self.assertEqual([(c.label, c.count) for c in choices
+                              if c.link_type == FILTER_ADD],
+                             [('10', 1), ('20', 2)])
+
+    def test_date_aggregation_backends(self):
+        # Database specific backends must give the same results as the
+        # generic one.
+        qs = Book.objects.all()
+        vendor = connections[qs.db].vendor
+        for kind in ['year', 'month', 'day']:
+            expected = date_aggregation(qs.dates('date_published', kind))
+            old_backends = backends.BACKENDS
+            backends.BACKENDS = {}
+            try:
+                generic = date_aggregation(qs.dates('date_published', kind))
+            finally:
+                backends.BACKENDS = old_backends
+            self.assertEqual(generic, expected, (vendor, kind))
+            # Dates, as Django gives them for DateFields from 1.6.
+            self.assertEqual(set(type(d) for d, count in expected),
+                             set([date if VERSION >= (1, 6) else datetime]))
+
+    def test_date_aggregation_datetimes(self):
+        # From Django 1.6, DateTimeFields are truncated as datetimes() does,
+        # in the current time zone if USE_TZ is True.
+        if VERSION < (1, 6):
+            return
+        Event.objects.all().delete()
+        for start in [datetime(2011, 12, 31, 23, 30), datetime(2012, 1, 1),
+                      datetime(2012, 3, 5, 6), None]:
+            Event.objects.create(name='Event', start=start)
+        qs = Event.objects.all()
+        self.assertEqual(date_aggregation(qs.datetimes('start', 'year')),
+                         [(datetime(2011, 1, 1), 1), (datetime(2012, 1, 1), 2)])
+        for kind in ['year', 'month', 'day']:
+            expected = date_aggregation(qs.datetimes('start', kind))
+            old_backends = backends.BACKENDS
+            backends.BACKENDS = {}
+            try:
+                generic = date_aggregation(qs.datetimes('start', kind))
+            finally:
+                backends.BACKENDS = old_backends
+            self.assertEqual(generic, expected, kind)
+
+        try:
+            import pytz
+        except ImportError:  # Needed by Django for time zones in queries
+            return
+        from django.utils import timezone
+        paris = pytz.timezone('Europe/Paris')
+        with self.settings(USE_TZ=True):
+            Event.objects.all().delete()
+            for start in [datetime(2011, 12, 31, 23, 30), datetime(2012, 1, 1),
+                          datetime(2012, 3, 5, 6)]:
+                Event.objects.create(name='Event',
+                                     start=start.replace(tzinfo=pytz.utc))
+            with timezone.override(paris):
+                counts = date_aggregation(qs.datetimes('start', 'year'))
+                self.assertEqual(counts,
+                                 [(paris.localize(datetime(2012, 1, 1)), 3)])
+                for kind in ['year', 'month', 'day']:
+                    self.assertEqual(
+                        [d for d, count in date_aggregation(
+                            qs.datetimes('start', kind))],
+                        list(qs.datetimes('start', kind)))
+
     def test_datetime_filter_start_at_year(self):
         # Tests that the first filter shown is a year, not a day,
         # even if initial query gets you down to a day.
@@ -838,7 +1805,7 @@ class TestFilters(TestCase):
 
         # Should only take 2 queries - one to find out how many distinct values,
         # one to get the counts.
-        with self.assertNumQueries(3):
+        with self.assertNumQueries(2):
             choices = filter1.get_choices(qs)
 
         self.assertEqual(len(choices), 1)
@@ -849,9 +1816,9 @@ class TestFilters(TestCase):
         filter1 = NumericRangeFilter('price', Book, MultiValueDict(), max_links=8)
 
         qs = Book.objects.all()
-        # Should take 3 queries - one to find out how many distinct values,
-        # one to find a range, one to get the counts.
-        with self.assertNumQueries(4):
+        # Should take 2 queries - one to find out how many distinct values and
+        # the range, one to get the counts.
+        with self.assertNumQueries(2):
             choices = filter1.get_choices(qs)
 
         self.assertTrue(len(choices) <= 8)
@@ -871,6 +1838,68 @@ class TestFilters(TestCase):
         self.assertTrue('i' not in p1.split('..')[0])
         self.assertTrue('i' in p1.split('..')[1])
 
+    def test_numericrange_filter_null_count(self):
+        filter1 = NumericRangeFilter('rating', Book, MultiValueDict(), max_links=5)
+        qs = Book.objects.all()
+        null_count = qs.filter(rating__isnull=True).count()
+        self.assertTrue(null_count > 0)
+
+        choices = filter1.get_choices(qs)
+        self.assertEqual(choices[0].label, '(null)')
+        self.assertEqual(choices[0].count, null_count)
+        # NULLs are not counted in any of the ranges.
+        self.assertEqual(sum(c.count for c in choices), qs.count())
+
+    def test_numericrange_uniform_ranges(self):
+        # Ranges of equal size are found using arithmetic in the SQL, which
+        # must agree with the comparisons used for other ranges.
+        qs = Book.objects.all()
+        for field in ['price', 'rating']:
+            values = [v for v in qs.values_list(field, flat=True)
+                      if v is not None]
+            ranges = auto_ranges(min(values), max(values), 8)
+            self.assertTrue(uniform_step(ranges) is not None)
+            counts = numeric_range_counts(qs, field, ranges, True)
+            for i, (lower, upper) in enumerate(ranges):
+                expected = len([v for v in values
+                                if lower < v <= upper or (i == 0 and v == lower)])
+                self.assertEqual(counts.get((lower, upper), 0), expected)
+
+    def test_numericrange_integer_values(self):
+        # Whole number values and bounds must not be divided as integers.
+        pks = [Book.objects.create(name='Edition %d' % edition,
+                                   price=Decimal('1.00'),
+                                   edition=edition).pk
+               for edition in [3, 12, 15, 25, 41, 47]]
+        qs = Book.objects.filter(pk__in=pks)
+        filter1 = NumericRangeFilter('edition', Book, MultiValueDict(),
+                                     max_links=5)
+        choices = filter1.get_choices(qs)
+        self.assertEqual([(c.label, c.count) for c in choices],
+                         [(u'0-10', 1), (u'10-20', 2), (u'20-30', 1),
+                          (u'40-50', 2)])
+
+        # Values below the first range or above the last one are counted in
+        # them if the ranges are clamped, as automatic ranges are, and are
+        # otherwise left out, also when the values are counted in memory.
+        rows = memory.FacetRows(qs, ['edition'])
+        for ranges, clamp, expected in [
+                ([(10, 20), (20, 30), (30, 40), (40, 50)], True,
+                 {(10, 20): 3, (20, 30): 1, (40, 50): 2}),
+                ([(10, 20), (20, 30)], True,
+                 {(10, 20): 3, (20, 30): 3}),
+                ([(10, 20), (20, 30), (30, 50)], True,
+                 {(10, 20): 3, (20, 30): 1, (30, 50): 2}),
+                ([(10, 20), (20, 30)], False,
+                 {(10, 20): 2, (20, 30): 1}),
+                ([(12, 20), (20, 30), (30, 50)], False,
+                 {(12, 20): 2, (20, 30): 1, (30, 50): 2})]:
+            counts = numeric_range_counts(qs, 'edition', ranges, clamp)
+            self.assertEqual(dict(counts), expected)
+            self.assertEqual(memory.numeric_range_counts(rows, 'edition',
+                                                         ranges, clamp),
+                             counts)
+
     def test_numericrange_filter_apply_filter(self):
         qs = Book.objects.all()
 
@@ -940,6 +1969,36 @@ class TestFilters(TestCase):
         self.assertEqual(len(choices), 1)
         self.assertEqual(choices[0].link_type, FILTER_REMOVE)
 
+    def test_urlencode_params(self):
+        """
+        Filter.urlencode_params should give the same result as urlencode(),
+        apart from the order of the parameters, which for urlencode() depends
+        on dict ordering.
+        """
+        qs = Book.objects.all()
+        for filter_class, field, query in [
+            (ValuesFilter, 'edition', 'a=1&edition=2&page=3&b=x%20y&b=z'),
+            (ValuesFilter, 'edition', 'a=1&page=3&edition--isnull='),
+            (ForeignKeyFilter, 'genre', 'genre=1&q=%C3%AB'),
+            (ManyToManyFilter, 'authors', 'authors=1&x=1&authors=2'),
+            (DateTimeFilter, 'date_published', 'date_published=1818&p=1'),
+            (NumericRangeFilter, 'price', 'o=1&page=2'),
+            ]:
+            filter_ = filter_class(field, Book, QueryDict(query))
+            choices = [c for c in filter_.get_choices(qs)
+                       if c.params is not None]
+            self.assertTrue(choices)
+            for choice in choices:
+                encoded = filter_.urlencode_params(choice.params)
+                expected = choice.params.urlencode()
+                self.assertEqual(sorted(encoded.split('&')),
+                                 sorted(expected.split('&')))
+                # The order of the values for each parameter is kept. Both
+                # are ASCII, but QueryDict needs bytes on Python 2 if they
+                # encode non-ASCII characters.
+                self.assertEqual(QueryDict(str(encoded)),
+                                 QueryDict(str(expected)))
+
     def test_order_by_count(self):
         """
         Tests the 'order_by_count' option.
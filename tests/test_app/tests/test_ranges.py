@@ -2,6 +2,7 @@ from decimal import Decimal
 import unittest
 
 from django_easyfilters.ranges import auto_ranges
+from django_easyfilters.ranges import uniform_step
 
 
 class TestRanges(unittest.TestCase):
@@ -82,3 +83,17 @@ class TestRanges(unittest.TestCase):
 
         r2 = auto_ranges(Decimal('1'), Decimal('10'), 10)
         self.assertEqual(type(r2[0][0]), Decimal)
+
+    def test_uniform_step(self):
+        self.assertEqual(uniform_step(auto_ranges(Decimal('15.1'),
+                                                  Decimal('19.9'), 5)),
+                         (Decimal('15.0'), Decimal('1.0')))
+        self.assertEqual(uniform_step(auto_ranges(0.3, 4.9, 5)),
+                         (Decimal('0.0'), Decimal('1.0')))
+        self.assertEqual(uniform_step([(1, 2, 'one'), (2, 3, 'two')]),
+                         (Decimal('1'), Decimal('1')))
+        # Irregular, overlapping, or empty ranges
+        self.assertEqual(uniform_step([(1, 2), (2, 4)]), None)
+        self.assertEqual(uniform_step([(1, 2), (3, 4)]), None)
+        self.assertEqual(uniform_step([(1, 1)]), None)
+        self.assertEqual(uniform_step([]), None)